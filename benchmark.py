@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for litesimple. Every benchmark runs against a temporary database
+and times litesimple next to the same work done with the sqlite3 module
+directly, so the cost litesimple adds on top of sqlite3 can be seen.
+
+Usage:
+    python benchmark.py [--rows 1000,10000] [--columns 4,16] [--repeat 3]
+                        [--only get,filter] [--no-memory] [--json]
+
+Each benchmark runs for every combination of table size and column count.
+With --json the results are printed as a single JSON document, which can be
+saved and compared with the results of another commit.
+
+The memory benchmark runs each model in a child process of its own, so the
+memory freed by one model can't be reused by the next.
+
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import atexit
+import shutil
+import sqlite3
+import argparse
+import datetime
+import resource
+import platform
+import tempfile
+import subprocess
+
+#litesimple reads the database name from a settings module. Use the one on
+#the path if there is one, otherwise make an empty one, and point it to a
+#temporary database either way.
+try:
+    import settings
+except ImportError:
+    settings = types.ModuleType("settings")
+    sys.modules["settings"] = settings
+
+#Child processes get the database of their parent in the environment.
+if "LITESIMPLE_BENCHMARK_DB" in os.environ:
+    settings.SQLITE_FILE = os.environ["LITESIMPLE_BENCHMARK_DB"]
+else:
+    _directory = tempfile.mkdtemp(prefix="litesimple-benchmark-")
+    settings.SQLITE_FILE = os.path.join(_directory, "benchmark.db")
+    atexit.register(shutil.rmtree, _directory, True)
+
+from litesimple import (SQLite, Model, ModelMeta, transaction, FieldInteger,
+                        FieldText, FieldDateTime)
+
+class BenchPlain(Model):
+    id = FieldInteger(is_key=True)
+    name = FieldText()
+    number = FieldInteger()
+    other = FieldInteger()
+
+class BenchCompact(Model):
+    __compact__ = True
+    id = FieldInteger(is_key=True)
+    name = FieldText()
+    number = FieldInteger()
+    other = FieldInteger()
+
+#Number of single row operations (save, get, delete) each benchmark runs.
+OPERATIONS = 2000
+
+_start = datetime.datetime(2020, 1, 1)
+
+#Kinds of columns of the generated models: the field and the value of row i.
+_kinds = {
+    "int": (FieldInteger, lambda i: i),
+    "text": (FieldText, lambda i: "row %d" % i),
+    "datetime": (FieldDateTime, lambda i: _start + datetime.timedelta(seconds=i)),
+}
+
+_models = {}
+
+def get_model(columns, kinds=("int", "text")):
+    """Get a model with an integer primary key and columns - 1 other
+    columns, cycling through kinds. The model and its table are created
+    the first time.
+
+    """
+    name = "bench_%s_%d" % ('_'.join(kinds), columns)
+    if name not in _models:
+        dct = {"id": FieldInteger(is_key=True)}
+        for i in range(columns - 1):
+            dct["c%d" % i] = _kinds[kinds[i % len(kinds)]][0]()
+        model = ModelMeta(name, (Model,), dct)
+        model._values_of_row = [_kinds[kinds[i % len(kinds)]][1] for i in range(columns - 1)]
+        SQLite.check_db(SQLite())
+        _models[name] = model
+    return _models[name]
+
+def make_instance(model, i):
+    """Create an unsaved instance of a generated model for row i."""
+    values = dict(("c%d" % n, value(i)) for n, value in enumerate(model._values_of_row))
+    return model(**values)
+
+def raw_columns(model):
+    """Get the column names of a generated model without the primary key."""
+    return ["c%d" % n for n in range(len(model._values_of_row))]
+
+def raw_row(model, i):
+    """Get the values of row i of a generated model as sqlite3 takes them."""
+    return tuple(model._fields[n + 1].to_db_format(value(i), True, False)
+                 for n, value in enumerate(model._values_of_row))
+
+def best_of(func, repeat=5, setup=None):
+    """Run func repeat times and return the fastest time in seconds. If
+    setup is given, it is called before every run and isn't timed.
+
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def fill(model, rows):
+    """Insert rows number of rows into the table of model."""
+    model.delete()
+    if model in (BenchPlain, BenchCompact):
+        model.bulk_save(model(name="row %d" % i, number=i) for i in range(rows))
+    else:
+        model.bulk_save(make_instance(model, i) for i in range(rows))
+
+def empty(model):
+    """Delete every row of the table of model."""
+    model.delete()
+
+def bench_save(model, rows, repeat):
+    """Compare saving instances one at a time in a transaction with running
+    an INSERT for each with sqlite3.
+
+    """
+    count = min(rows, OPERATIONS)
+    columns = raw_columns(model)
+    statement = "INSERT INTO %s (%s) VALUES (%s)" % (
+        model._tablename, ', '.join(columns), ', '.join("?" * len(columns)))
+    data = [raw_row(model, i) for i in range(count)]
+    instances = [make_instance(model, i) for i in range(count)]
+
+    def raw():
+        connection = SQLite()
+        connection.execute("BEGIN")
+        for row in data:
+            connection.execute(statement, row)
+        connection.execute("COMMIT")
+
+    def orm():
+        with transaction():
+            for instance in instances:
+                instance._saved = False
+                instance.save()
+
+    setup = lambda: empty(model)
+    return count, best_of(raw, repeat, setup), best_of(orm, repeat, setup)
+
+def bench_save_batch(model, rows, repeat):
+    """Compare bulk_save with executemany of the same INSERT."""
+    columns = raw_columns(model)
+    statement = "INSERT INTO %s (%s) VALUES (%s)" % (
+        model._tablename, ', '.join(columns), ', '.join("?" * len(columns)))
+    data = [raw_row(model, i) for i in range(rows)]
+    instances = [make_instance(model, i) for i in range(rows)]
+
+    def raw():
+        connection = SQLite()
+        connection.execute("BEGIN")
+        connection.executemany(statement, data)
+        connection.execute("COMMIT")
+
+    def orm():
+        for instance in instances:
+            instance._saved = False
+        model.bulk_save(instances)
+
+    setup = lambda: empty(model)
+    return rows, best_of(raw, repeat, setup), best_of(orm, repeat, setup)
+
+def bench_get(model, rows, repeat):
+    """Compare getting single rows by primary key with get to running the
+    same SELECT with sqlite3.
+
+    """
+    fill(model, rows)
+    keys = [1 + (i * 7919) % rows for i in range(OPERATIONS)]
+    statement = "SELECT %s FROM %s WHERE id = ?" % (', '.join(model._columns),
+                                                     model._tablename)
+
+    def raw():
+        connection = SQLite()
+        for key in keys:
+            connection.execute(statement, (key,)).fetchone()
+
+    def orm():
+        for key in keys:
+            model.get(key)
+
+    return len(keys), best_of(raw, repeat), best_of(orm, repeat)
+
+def bench_filter(model, rows, repeat):
+    """Compare loading half of the rows of a table with filter to fetching
+    them as tuples with sqlite3. Every attribute of the instances is read,
+    so fields that convert their values do so.
+
+    """
+    fill(model, rows)
+    statement = "SELECT %s FROM %s WHERE c0 >= ?" % (', '.join(model._columns),
+                                                     model._tablename)
+    attrs = model._attrs
+
+    def raw():
+        SQLite().execute(statement, (rows // 2,)).fetchall()
+
+    def orm():
+        for instance in model.filter(c0__gte=rows // 2):
+            for attr in attrs:
+                getattr(instance, attr)
+
+    return rows - rows // 2, best_of(raw, repeat), best_of(orm, repeat)
+
+def bench_filter_convert(model, rows, repeat):
+    """Same as bench_filter, on a model of text and datetime fields."""
+    columns = len(model._columns)
+    return bench_filter(get_model(columns, ("int", "text", "datetime")), rows, repeat)
+
+def bench_hydration(model, rows, repeat):
+    """Compare turning rows that were already fetched into instances with
+    _result_to_model to turning them into dictionaries.
+
+    """
+    fill(model, rows)
+    columns = model._columns
+    data = SQLite().execute("SELECT %s FROM %s" % (', '.join(columns),
+                                                   model._tablename)).fetchall()
+
+    def raw():
+        [dict(zip(columns, row)) for row in data]
+
+    def orm():
+        [model._result_to_model(row) for row in data]
+
+    return rows, best_of(raw, repeat), best_of(orm, repeat)
+
+def bench_delete(model, rows, repeat):
+    """Compare deleting instances one at a time in a transaction with
+    running a DELETE for each with sqlite3.
+
+    """
+    count = min(rows, OPERATIONS)
+    statement = "DELETE FROM %s WHERE id = ?" % model._tablename
+    state = {}
+
+    def setup():
+        fill(model, rows)
+        state["instances"] = list(model.filter()[:count])
+
+    def raw():
+        connection = SQLite()
+        connection.execute("BEGIN")
+        for instance in state["instances"]:
+            connection.execute(statement, (instance.id,))
+        connection.execute("COMMIT")
+
+    def orm():
+        with transaction():
+            for instance in state["instances"]:
+                instance.delete()
+
+    return count, best_of(raw, repeat, setup), best_of(orm, repeat, setup)
+
+def bench_startup(model, rows, repeat):
+    """Compare check_db on an up to date database, which runs on the first
+    connection of a program, with reading the schema with sqlite3. The
+    create statements of every model are generated each time.
+
+    """
+    connection = SQLite()
+    models = list(ModelMeta.models.values())
+
+    def raw():
+        connection.execute("SELECT type, name FROM sqlite_master").fetchall()
+
+    def orm():
+        for x in models:
+            x.get_create_statement()
+            x.get_index_statements()
+        SQLite.check_db(connection)
+
+    return len(models), best_of(raw, repeat), best_of(orm, repeat)
+
+BENCHMARKS = [
+    ("save", bench_save),
+    ("save_batch", bench_save_batch),
+    ("get", bench_get),
+    ("filter", bench_filter),
+    ("filter_convert", bench_filter_convert),
+    ("hydration", bench_hydration),
+    ("delete", bench_delete),
+    ("startup", bench_startup),
+]
+
+def resident_memory():
+    """Get the resident memory of the process in kilobytes. Linux keeps the
+    peak memory of a process across exec, so the current size is read from
+    /proc where there is one.
+
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def memory_child(name):
+    """Load every row of the model's table and print by how many kilobytes
+    it grew the memory of the process. Runs in a child process.
+
+    """
+    model = globals()[name]
+    SQLite()
+    before = resident_memory()
+    instances = list(model.filter())
+    print(resident_memory() - before)
+
+def bench_memory(rows):
+    """Compare the memory used to hold every row of a table as normal and
+    as compact model instances.
+
+    """
+    results = []
+    environment = dict(os.environ, LITESIMPLE_BENCHMARK_DB=settings.SQLITE_FILE)
+    for model in (BenchPlain, BenchCompact):
+        fill(model, rows)
+        SQLite().execute("PRAGMA wal_checkpoint")
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                          "--memory-child", model.__name__],
+                                         env=environment)
+        results.append({"model": model.__name__, "rows": rows,
+                        "kilobytes": int(output.strip())})
+    return results
+
+def run(sizes, column_counts, names, repeat, memory):
+    """Run the benchmarks and return the results as a dictionary."""
+    results = []
+    for rows in sizes:
+        for columns in column_counts:
+            model = get_model(columns)
+            for name, func in BENCHMARKS:
+                if name not in names:
+                    continue
+                operations, raw, orm = func(model, rows, repeat)
+                results.append({"benchmark": name, "rows": rows, "columns": columns,
+                                "operations": operations, "sqlite3": raw,
+                                "litesimple": orm, "factor": orm / raw if raw else None})
+
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "repeat": repeat,
+        "results": results,
+        "memory": [x for rows in sizes for x in bench_memory(rows)] if memory else [],
+    }
+
+def print_report(report):
+    """Print the results of run as tables."""
+    print("python %s, sqlite %s, best of %d" % (report["python"], report["sqlite"],
+                                                 report["repeat"]))
+    print("")
+    print("%-15s %8s %7s %6s %10s %10s %7s" % ("benchmark", "rows", "columns", "ops",
+                                              "sqlite3", "litesimple", "factor"))
+    for x in report["results"]:
+        print("%-15s %8d %7d %6d %9.4fs %9.4fs %6.1fx" % (
+            x["benchmark"], x["rows"], x["columns"], x["operations"],
+            x["sqlite3"], x["litesimple"], x["factor"] or 0))
+
+    if report["memory"]:
+        print("")
+        print("%-15s %8s %10s" % ("memory", "rows", "kB"))
+        for x in report["memory"]:
+            print("%-15s %8d %10d" % (x["model"], x["rows"], x["kilobytes"]))
+
+def main(argv):
+    if len(argv) > 2 and argv[1] == "--memory-child":
+        return memory_child(argv[2])
+
+    names = [name for name, func in BENCHMARKS]
+    numbers = lambda value: [int(x) for x in value.split(",")]
+    parser = argparse.ArgumentParser(description="Benchmark litesimple against sqlite3.")
+    parser.add_argument("--rows", type=numbers, default=[1000, 10000],
+                        help="comma separated table sizes (default: 1000,10000)")
+    parser.add_argument("--columns", type=numbers, default=[4, 16],
+                        help="comma separated column counts (default: 4,16)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs to take the best of (default: 3)")
+    parser.add_argument("--only", type=lambda value: value.split(","), default=names,
+                        help="comma separated benchmarks to run, of %s" % ', '.join(names))
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the memory benchmark")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    args = parser.parse_args(argv[1:])
+
+    unknown = set(args.only) - set(names)
+    if unknown:
+        parser.error("unknown benchmark %s" % ', '.join(sorted(unknown)))
+    if min(args.columns) < 2:
+        parser.error("models need at least 2 columns")
+
+    report = run(args.rows, args.columns, args.only, args.repeat, args.memory)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -13,66 +13,291 @@ License: WTFPL (see LICENSE for details)
 
 """
 
+import csv
+import json
+import time
+import atexit
+import datetime
 import sqlite3
+import operator
+import itertools
+import multiprocessing
 import functools
+import threading
+import weakref
+import collections
 import settings
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 ######################################################################3###
 ### 
 
 class SQLite(object):
-    """A Singleton class that, once called, creates a single sqlite
-    connection and reuses it everytime it's called.
+    """A Singleton class that, once called, creates an sqlite connection
+    for the calling thread and reuses it everytime it's called from that
+    thread.
+
+    Every thread gets its own connection so threads never share one, and
+    with the database in WAL mode they can all read at the same time. The
+    connections are closed when the program exits, or with close_all.
 
     The name of the database is retrieved from a named variable
-    SQLITE_FILE from a module called settings.
+    SQLITE_FILE from a module called settings. Note that every connection
+    to an ":memory:" database is a separate database, so with it each
+    thread sees its own tables.
+
+    The settings can also tune every connection with PRAGMAs, either by
+    naming one of the PROFILES in SQLITE_PROFILE, by listing them in a
+    SQLITE_PRAGMAS dict or both, in which case SQLITE_PRAGMAS overrides
+    the profile:
+
+        SQLITE_PROFILE = "fast"
+        SQLITE_PRAGMAS = {"cache_size": -200000}
 
     """
 
-    _connection = None
+    #Named PRAGMA presets for SQLITE_PROFILE. "durable" survives power
+    #loss, "fast" can lose the last commits on power loss but never
+    #corrupts the database and "bulk-load" is only meant for loading
+    #data that can be loaded again, as a crash can corrupt the database.
+    PROFILES = {
+        "durable": {
+            "journal_mode": "WAL",
+            "synchronous": "FULL",
+            "busy_timeout": 5000,
+        },
+        "fast": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -64000,
+            "mmap_size": 268435456,
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,
+        },
+        "bulk-load": {
+            "journal_mode": "MEMORY",
+            "synchronous": "OFF",
+            "cache_size": -256000,
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,
+        },
+    }
+
+    #PRAGMAs that have to be run in a certain order. page_size has to come
+    #before the database is switched to WAL, after which it can't change.
+    _pragma_order = ("page_size", "journal_mode", "synchronous", "cache_size",
+                     "mmap_size", "temp_store", "busy_timeout")
+
+    #Holds the connection of the current thread and the number of
+    #transaction blocks currently open on it.
+    _local = threading.local()
+
+    #Every open connection along with the thread it belongs to.
+    _connections = []
+    _lock = threading.Lock()
+
+    #Connections inherited from the parent process by reset_after_fork.
+    #They are never let go of, as freeing them would close them.
+    _inherited = []
+
+    #Whether check_db has been run for the database.
+    _checked = False
+
     def __new__(cls, *args, **kwargs):
-        """Gets an SQLite singleton instance. If one doesn't exist, one is
-        created automatically.
+        """Gets the SQLite singleton instance of the current thread. If one
+        doesn't exist, one is created automatically.
+
+        """
+        connection = getattr(cls._local, "connection", None)
+        if connection is None:
+            connection = cls._connect()
+
+        #Return the sqlite3 singleton instance of the current thread.
+        return connection
+
+    @classmethod
+    def _connect(cls):
+        """A hidden method that opens a new connection for the current
+        thread and stores it.
+
+        """
+
+        #Create a new sqlite3 instance. We manage transactions ourselves
+        #(see transaction) so the connection is opened in autocommit mode,
+        #which also stops the sqlite3 module from silently commiting before
+        #SAVEPOINT statements. The connection is only ever used by the
+        #current thread but close_all has to be able to close it from
+        #another one, hence check_same_thread.
+        pragmas = cls.pragmas()
+        connection = sqlite3.connect(settings.SQLITE_FILE,
+                                     isolation_level=None,
+                                     check_same_thread=False,
+                                     cached_statements=cls.cached_statements())
+
+        for name, value in pragmas:
+            connection.execute("PRAGMA %s = %s" % (name, value))
+
+        with cls._lock:
+            #Close connections left behind by threads that have finished.
+            for thread, other in cls._connections[:]:
+                if not thread.is_alive():
+                    other.close()
+                    cls._connections.remove((thread, other))
+            cls._connections.append((threading.current_thread(), connection))
+
+            #Call the checkdb to make sure all tables exist. This will
+            #automatically create the tables for us if they don't exist.
+            #Other threads wait on the lock until the tables are there.
+            #Programs that know the schema is in place, like short lived
+            #workers, can skip this with SQLITE_SKIP_SCHEMA_CHECK.
+            if getattr(settings, "SQLITE_SKIP_SCHEMA_CHECK", False):
+                pass
+            elif not cls._checked or settings.SQLITE_FILE == ":memory:":
+                cls.check_db(connection)
+                cls._checked = True
+
+        cls._local.connection = connection
+        cls._local.depth = 0
+        return connection
+
+    @classmethod
+    def reset_after_fork(cls):
+        """Forget the connections inherited from the parent process, in a
+        child process started with fork. SQLite connections must not be
+        used, or even closed, in a child process, so they are put aside
+        and the child opens its own.
+
+        """
+        cls._inherited.extend(connection for thread, connection in cls._connections)
+        cls._local = threading.local()
+        cls._connections = []
+        cls._lock = threading.Lock()
+        DatabaseThread._instance = None
+        DatabaseThread._lock = threading.Lock()
+        ModelCache.clear_all()
+
+    @classmethod
+    def close(cls):
+        """Close the connection of the current thread, if it has one. A new
+        one is opened the next time it's needed.
+
+        """
+        connection = getattr(cls._local, "connection", None)
+        if connection is None:
+            return
+
+        cls._local.connection = None
+        with cls._lock:
+            cls._connections = [x for x in cls._connections if x[1] is not connection]
+        connection.close()
+
+    @classmethod
+    def close_all(cls):
+        """Close the connections of every thread. This is done automatically
+        when the program exits. Threads get a new connection the next time
+        they need one.
 
         """
+        with cls._lock:
+            connections = cls._connections
+            cls._connections = []
+            cls._checked = False
+        cls._local = threading.local()
+        for thread, connection in connections:
+            connection.close()
 
-        if not cls._connection:
-            #Create a new sqlite3 instance and save it into the class,
-            #effectively making it permanent.
-            cls._connection = sqlite3.connect(settings.SQLITE_FILE)
+    @staticmethod
+    def cached_statements():
+        """Get the number of prepared statements each connection keeps
+        cached. It can be set with SQLITE_CACHED_STATEMENTS in the settings
+        and should be at least the number of different statements the
+        program runs often, so they are not parsed again every time.
+
+        """
+        return getattr(settings, "SQLITE_CACHED_STATEMENTS", 100)
+
+    @classmethod
+    def pragmas(cls):
+        """Get the PRAGMAs to run on every new connection from the
+        SQLITE_PROFILE and SQLITE_PRAGMAS settings.
 
-            #Call the checkdb to make sure all tables exist.
-            #This will automatically create the tables for us
-            #if they don't exist.
-            cls.check_db(cls._connection)
+        Returns:
+            A list of (name, value) tuples in the order they should run.
 
-        #Return the sqlite3 singleton instance saved inside the class.
-        return cls._connection
+        """
+        pragmas = {}
+        profile = getattr(settings, "SQLITE_PROFILE", None)
+        if profile is not None:
+            if profile not in cls.PROFILES:
+                raise ValueError("Unknown SQLITE_PROFILE '%s'. Supported profiles are %s." %
+                                 (profile, ', '.join(sorted(cls.PROFILES))))
+            pragmas.update(cls.PROFILES[profile])
+        pragmas.update(getattr(settings, "SQLITE_PRAGMAS", {}))
+
+        ordered = [x for x in cls._pragma_order if x in pragmas]
+        ordered += sorted(x for x in pragmas if x not in cls._pragma_order)
+        return [(x, pragmas[x]) for x in ordered]
 
     @staticmethod
     def check_db(connection):
-        """Check the database to make sure all tables exist and
+        """Check the database to make sure all tables and indexes exist and
         automatically create them if they don't.
 
+        The schema is read once and everything missing is created in a
+        single transaction, so a database that is up to date only costs a
+        single query.
+
         Args:
             connection: The SQLite connection database to check.
 
         """
 
         cursor = connection.cursor()
+        if SQLite._get_missing(cursor):
+            #Another process might be creating the same tables, so check
+            #again once we hold the write lock.
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for model, create, indexes in SQLite._get_missing(cursor):
+                    if create:
+                        SQLite.create_table(cursor, model)
+                    for index in indexes:
+                        cursor.execute(index.get_create_statement(model._tablename))
+                cursor.execute("COMMIT")
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+        cursor.close()
+
+    @staticmethod
+    def _get_missing(cursor):
+        """Private method that reads the schema of the database and finds
+        the tables and indexes of models that are missing from it.
 
-        #loop over each and every subclass that inherits Model
-        for c in Model.__subclasses__():
-            #We only check if the table exists and not the columns.
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
-                (c._tablename,))
+        Args:
+            cursor: Current open database cursor to use.
 
-            #If the table doesn't exist, this will return None.
-            if cursor.fetchone() == None:
-                SQLite.create_table(cursor, c)
+        Returns:
+            A list of (model, missing table, missing indexes) tuples for
+            every model that is missing something.
 
-        connection.commit()
-        cursor.close()
+        """
+        #We only check if the tables and indexes exist and not their columns.
+        cursor.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'index')")
+        schema = set(cursor.fetchall())
+
+        missing = []
+        for model in ModelMeta.models.values():
+            create = ("table", model._tablename) not in schema
+            indexes = [index for index in model._indexes
+                       if ("index", index.get_name(model._tablename)) not in schema]
+            if create or indexes:
+                missing.append((model, create, indexes))
+        return missing
 
     @staticmethod
     def create_table(cursor, model):
@@ -87,6 +312,672 @@ class SQLite(object):
 
         cursor.execute(model.get_create_statement())
 
+atexit.register(SQLite.close_all)
+
+class transaction(object):
+    """A context manager that groups every save and delete done inside it
+    into a single transaction. The transaction is commited when the block
+    exits and rolled back if it exits with an exception.
+
+    Outside of a transaction block, every statement is commited on its own.
+
+    Blocks can be nested. Nested blocks use SAVEPOINTs so an exception
+    inside one only rolls back the changes made inside that block, while
+    the final commit only happens when the outermost block exits.
+
+    Transactions belong to the connection of the current thread, so
+    every thread has its own.
+
+    Example:
+        with transaction():
+            car(make="Opel").save()
+            car.delete(make="BMW")
+
+    """
+
+    def __enter__(self):
+        """Begin a transaction, or a savepoint if one is already active."""
+        connection = SQLite()
+        local = SQLite._local
+        if local.depth == 0:
+            connection.execute("BEGIN")
+        else:
+            connection.execute("SAVEPOINT litesimple_%d" % local.depth)
+        local.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Commit or release the current level if the block succeeded,
+        otherwise roll it back. Exceptions are never suppressed.
+
+        """
+        connection = SQLite()
+        local = SQLite._local
+        local.depth -= 1
+
+        if local.depth > 0:
+            savepoint = "litesimple_%d" % local.depth
+            if exc_type is not None:
+                connection.execute("ROLLBACK TO %s" % savepoint)
+                ModelCache.clear_all()
+            connection.execute("RELEASE %s" % savepoint)
+        elif exc_type is not None:
+            connection.execute("ROLLBACK")
+            ModelCache.clear_all()
+        else:
+            try:
+                connection.execute("COMMIT")
+            except:
+                #A failed commit (for example a locked database) leaves the
+                #transaction open. Roll it back so the connection is usable.
+                connection.execute("ROLLBACK")
+                ModelCache.clear_all()
+                raise
+        return False
+
+class DatabaseThread(object):
+    """A thread with its own connection that runs database calls for
+    asyncio code, so the event loop isn't blocked while sqlite works. The
+    aget, afilter and asave methods of models run on it.
+
+    Each event loop has at most SQLITE_ASYNC_QUEUE_SIZE calls (default:
+    1000) sent to the thread that aren't done yet. Calls beyond that wait on
+    the event loop until one of them is done, so the code awaiting them is
+    held back instead of the queue growing.
+
+    Writes that are waiting in the queue next to each other are run in a
+    single transaction, at most SQLITE_ASYNC_BATCH_SIZE (default: 100) at a
+    time. Each of them gets a savepoint of its own so a failing write
+    doesn't undo the others.
+
+    Instances handed to the thread, like the ones being saved, shouldn't be
+    changed until the call is done.
+
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        """Initialize the queue and start the thread."""
+        self.queue = queue.Queue()
+        self.queue_size = getattr(settings, "SQLITE_ASYNC_QUEUE_SIZE", 1000)
+        if self.queue_size < 1:
+            raise ValueError("SQLITE_ASYNC_QUEUE_SIZE must be at least 1.")
+
+        #The number of free places and the calls waiting for one, for every
+        #event loop. Only used from the thread running the loop.
+        self._bounds = weakref.WeakKeyDictionary()
+        self.closed = False
+        self.batch_size = getattr(settings, "SQLITE_ASYNC_BATCH_SIZE", 100)
+        self.thread = threading.Thread(target=self._run, name="litesimple")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def instance(cls):
+        """Get the database thread, starting it if it isn't running."""
+        with cls._lock:
+            if cls._instance is None or not cls._instance.thread.is_alive():
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def shutdown(cls):
+        """Stop the database thread once the calls already queued are done
+        and close its connection. Calls still waiting for a place fail with
+        a RuntimeError.
+
+        """
+        with cls._lock:
+            instance, cls._instance = cls._instance, None
+        if instance is None:
+            return
+
+        instance.closed = True
+        for loop in list(instance._bounds.keys()):
+            try:
+                loop.call_soon_threadsafe(instance._fail_waiting, loop)
+            except RuntimeError:
+                #The event loop is closed, nothing is waiting on it anymore.
+                pass
+        if instance.thread.is_alive():
+            instance.queue.put(None)
+            instance.thread.join()
+
+    def submit(self, func, write=False):
+        """Run a function on the database thread. Has to be called from the
+        thread running the event loop.
+
+        Parameters:
+            func: The function to run. It is called without arguments.
+            write: Boolean specifying whether the function writes to the
+                database, so it can be batched with other writes.
+
+        Returns:
+            An asyncio future of the result of the function.
+
+        """
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        item = (loop, future, func, write)
+        bound = self._bounds.get(loop)
+        if bound is None:
+            bound = self._bounds[loop] = [self.queue_size, collections.deque()]
+        if bound[0] > 0:
+            bound[0] -= 1
+            self.queue.put_nowait(item)
+        else:
+            bound[1].append(item)
+        return future
+
+    def _release(self, loop):
+        """Private method giving the place of a call that is done to the
+        next waiting call of the event loop. Calls that were cancelled while
+        waiting are dropped.
+
+        """
+        bound = self._bounds[loop]
+        waiting = bound[1]
+        while waiting and not self.closed:
+            item = waiting.popleft()
+            if not item[1].cancelled():
+                self.queue.put_nowait(item)
+                return
+        self._fail_waiting(loop)
+        bound[0] += 1
+
+    def _fail_waiting(self, loop):
+        """Private method failing the calls of the event loop that are
+        still waiting for a place once the thread is shut down.
+
+        """
+        if not self.closed:
+            return
+        waiting = self._bounds[loop][1]
+        while waiting:
+            future = waiting.popleft()[1]
+            if not future.done():
+                future.set_exception(RuntimeError("The database thread was shut down."))
+
+    def _run(self):
+        """Private method running the calls from the queue until it gets
+        None. Writes are collected into batches until a read, or the queue
+        runs empty.
+
+        """
+        item = self.queue.get()
+        while item is not None:
+            following = _unset
+            if item[3]:
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        following = self.queue.get_nowait()
+                    except queue.Empty:
+                        following = _unset
+                        break
+                    if following is None or not following[3]:
+                        break
+                    batch.append(following)
+                    following = _unset
+                self._write(batch)
+            else:
+                self._resolve(item, *self._call(item[2]))
+            item = self.queue.get() if following is _unset else following
+        SQLite.close()
+
+    def _write(self, batch):
+        """Private method running a batch of writes in a transaction."""
+        results = []
+        try:
+            with transaction():
+                for item in batch:
+                    results.append(self._call(functools.partial(self._savepoint, item[2])))
+        except Exception as e:
+            results = [(None, e)] * len(batch)
+        for item, result in zip(batch, results):
+            self._resolve(item, *result)
+
+    @staticmethod
+    def _savepoint(func):
+        """Private method calling func in a nested transaction."""
+        with transaction():
+            return func()
+
+    @staticmethod
+    def _call(func):
+        """Private method calling func and returning a tuple of its result
+        and the exception it raised, if any.
+
+        """
+        try:
+            return func(), None
+        except Exception as e:
+            return None, e
+
+    def _resolve(self, item, result, error):
+        """Private method setting the result of the future of a call from
+        the thread of its event loop.
+
+        """
+        loop, future = item[0], item[1]
+
+        def resolve():
+            self._release(loop)
+            if future.cancelled():
+                return
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            #The event loop was closed while the call was running.
+            pass
+
+atexit.register(DatabaseThread.shutdown)
+
+class Index(object):
+    """An index on one or more columns of a model, created by check_db.
+
+    Single columns can be indexed with Field(indexed=True). Indexes on more
+    than one column, unique indexes and partial indexes are listed in the
+    __indexes__ attribute of the model:
+
+        class car(Model):
+            __indexes__ = [
+                Index("make", "model"),
+                Index("sold", where="sold IS NOT NULL"),
+            ]
+
+    Attributes:
+        columns: The names of the indexed columns, in order.
+        name: Name of the index. Defaults to idx_<table>_<columns>.
+        unique: Specify whether the index is unique.
+        where: SQL condition of a partial index or None.
+
+    """
+
+    def __init__(self, *columns, **kwargs):
+        """Initializes the Index with the specified options.
+
+        Parameters:
+            *columns: Names of the columns to index.
+            name: Name of the index. Defaults to idx_<table>_<columns>.
+            unique: Boolean specifying whether the index is unique.
+            where: The condition of a partial index as an SQL expression.
+
+        """
+        if not columns:
+            raise TypeError("An index needs at least one column.")
+        self.columns = columns
+        self.name = kwargs.pop("name", None)
+        self.unique = kwargs.pop("unique", False)
+        self.where = kwargs.pop("where", None)
+        if kwargs:
+            raise TypeError("Unknown index option %s." % ', '.join(kwargs))
+
+    def get_name(self, tablename):
+        """Get the name of the index on the table."""
+        return self.name or "idx_%s_%s" % (tablename, '_'.join(self.columns))
+
+    def get_create_statement(self, tablename):
+        """Generate the CREATE INDEX statement for the index on the table.
+
+        Parameters:
+            tablename: Name of the table the index belongs to.
+
+        Returns:
+            A string containing the full CREATE INDEX statement.
+
+        """
+        statement = "CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)" % (
+            "UNIQUE " if self.unique else "",
+            self.get_name(tablename),
+            tablename,
+            ', '.join(self.columns))
+        if self.where:
+            statement += " WHERE %s" % self.where
+        return statement
+
+CacheInfo = collections.namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+class ModelCache(object):
+    """A bounded cache of model instances keyed by primary key, used by
+    Model.get. When full, the least recently used instance is dropped.
+
+    A model turns it on by setting __cache_size__ to the number of
+    instances to keep, and optionally __cache_ttl__ to the number of
+    seconds an instance may be kept:
+
+        class config(Model):
+            __cache_size__ = 100
+            __cache_ttl__ = 60
+
+    The cache works as an identity map, so getting the same primary key
+    twice returns the same instance. Saving or deleting through the model
+    removes the affected instances and rolling back a transaction empties
+    every cache. Changes made by other connections are detected with
+    PRAGMA data_version, which empties the cache. The cache is shared by
+    every thread and isn't used inside a transaction, so changes that
+    aren't commited never end up in it.
+
+    Attributes:
+        size: Maximum number of instances to keep.
+        ttl: Number of seconds an instance is kept, or None for no limit.
+        hits: Number of lookups found in the cache.
+        misses: Number of lookups not found in the cache.
+
+    """
+
+    #Every cache created, so they can all be emptied when a transaction
+    #is rolled back.
+    _caches = []
+
+    def __init__(self, size, ttl=None):
+        """Initialize an empty cache.
+
+        Parameters:
+            size: Maximum number of instances to keep.
+            ttl: Number of seconds an instance is kept. Defaults to no limit.
+
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        #PRAGMA data_version is only comparable on the same connection, and
+        #every thread has its own, so each thread keeps the last one seen.
+        self._local = threading.local()
+        ModelCache._caches.append(self)
+
+    def get(self, key):
+        """Get the instance with the primary key or None if it isn't
+        cached or has expired.
+
+        """
+
+        #Another connection changing the database bumps its data_version,
+        #and we can't know what changed so everything has to go.
+        version = SQLite().execute("PRAGMA data_version").fetchone()[0]
+        with self._lock:
+            if version != getattr(self._local, "data_version", None):
+                self._items.clear()
+                self._local.data_version = version
+
+            item = self._items.pop(key, None)
+            if item is None or (item[1] is not None and item[1] < time.time()):
+                self.misses += 1
+                return None
+
+            #Put it back in at the end, marking it as the most recently used.
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, instance):
+        """Add the instance to the cache, dropping the least recently used
+        one if the cache is full.
+
+        """
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._items.pop(key, None)
+            if len(self._items) >= self.size:
+                self._items.popitem(last=False)
+            self._items[key] = (instance, expires)
+
+    def discard(self, key):
+        """Remove the instance with the primary key if it is cached."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        """Remove every instance from the cache."""
+        with self._lock:
+            self._items.clear()
+
+    def info(self):
+        """Get the hits, misses, maximum size and current size of the cache
+        as a CacheInfo named tuple.
+
+        """
+        return CacheInfo(self.hits, self.misses, self.size, len(self._items))
+
+    @classmethod
+    def clear_all(cls):
+        """Remove every instance from every cache."""
+        for cache in cls._caches:
+            cache.clear()
+
+QueryEvent = collections.namedtuple("QueryEvent",
+    "model operation statement parameters duration hydration rows plan")
+QueryStats = collections.namedtuple("QueryStats", "count duration hydration rows")
+class Instrumentation(object):
+    """Instrumentation of the statements litesimple runs. It is off by
+    default and costs a single check per statement until turned on, either
+    with enable or with SQLITE_INSTRUMENT = True in the settings.
+
+    Every statement is reported as a QueryEvent with the model, the
+    operation (SELECT, INSERT, UPDATE or DELETE), the statement and its
+    parameters, the seconds spent in sqlite, the seconds spent turning rows
+    into instances, the number of rows fetched or changed and the query
+    plan, if it was captured. Bulk writes are reported once per
+    executemany, with the parameters left out. SELECTs are reported when
+    their cursor is closed, once every row has been fetched.
+
+    The events go to the callbacks added with add_callback, are added up
+    per model and operation in stats, and statements that spent at least
+    slow_threshold seconds in sqlite are kept in slow_queries. With
+    explain_slow, the EXPLAIN QUERY PLAN of those statements is captured
+    too. The settings SQLITE_SLOW_QUERY and SQLITE_EXPLAIN_SLOW set them.
+
+    Example:
+        Instrumentation.enable(slow_threshold=0.1, explain_slow=True)
+        Instrumentation.add_callback(lambda event: print(event.statement))
+        car.filter(make="Opel").count()
+        print(Instrumentation.stats()[("car", "SELECT")].duration)
+
+    """
+
+    enabled = getattr(settings, "SQLITE_INSTRUMENT", False)
+    slow_threshold = getattr(settings, "SQLITE_SLOW_QUERY", None)
+    explain_slow = getattr(settings, "SQLITE_EXPLAIN_SLOW", False)
+    slow_queries = collections.deque(maxlen=100)
+
+    _callbacks = []
+    _stats = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def enable(cls, slow_threshold=None, explain_slow=False, slow_log_size=100):
+        """Turn the instrumentation on.
+
+        Parameters:
+            slow_threshold: Seconds a statement has to spend in sqlite to be
+                kept in slow_queries, or None to keep none.
+            explain_slow: Boolean specifying whether to capture the query
+                plan of slow statements.
+            slow_log_size: Number of slow statements to keep.
+
+        """
+        cls.slow_threshold = slow_threshold
+        cls.explain_slow = explain_slow
+        cls.slow_queries = collections.deque(cls.slow_queries, maxlen=slow_log_size)
+        cls.enabled = True
+
+    @classmethod
+    def disable(cls):
+        """Turn the instrumentation off."""
+        cls.enabled = False
+
+    @classmethod
+    def add_callback(cls, callback):
+        """Add a function that is called with the QueryEvent of every
+        statement, on the thread that ran it.
+
+        """
+        with cls._lock:
+            cls._callbacks = cls._callbacks + [callback]
+
+    @classmethod
+    def remove_callback(cls, callback):
+        """Remove a function added with add_callback."""
+        with cls._lock:
+            cls._callbacks = [x for x in cls._callbacks if x is not callback]
+
+    @classmethod
+    def stats(cls):
+        """Get the counters of the statements run so far.
+
+        Returns:
+            A dictionary of QueryStats named tuples keyed by the table name
+            of the model and the operation.
+
+        """
+        with cls._lock:
+            return dict((key, QueryStats(*value)) for key, value in cls._stats.items())
+
+    @classmethod
+    def reset(cls):
+        """Reset the counters and empty slow_queries."""
+        with cls._lock:
+            cls._stats = {}
+            cls.slow_queries.clear()
+
+    @classmethod
+    def execute(cls, model, operation, cursor, statement, parameters):
+        """Execute a statement on the cursor and report it. SELECTs get
+        their cursor wrapped in an InstrumentedCursor, which reports them
+        once it is closed.
+
+        Returns:
+            The cursor of the executed statement.
+
+        """
+        start = time.time()
+        cursor.execute(statement, parameters)
+        duration = time.time() - start
+        if operation != "SELECT":
+            cls.record(model, operation, statement, parameters, duration, cursor.rowcount)
+            return cursor
+        return InstrumentedCursor(model, cursor, statement, parameters, duration)
+
+    @classmethod
+    def record(cls, model, operation, statement, parameters, duration, rows, hydration=0.0):
+        """Report a statement that has run.
+
+        Parameters:
+            model: The model class the statement belongs to.
+            operation: The type of the statement, like SELECT.
+            statement: The sql of the statement.
+            parameters: The parameters of the statement, or None if they
+                are not known.
+            duration: Seconds spent in sqlite.
+            rows: Number of rows fetched or changed.
+            hydration: Seconds spent turning rows into instances.
+
+        """
+        plan = None
+        if cls.explain_slow and parameters is not None and cls._is_slow(duration):
+            try:
+                plan = [row[-1] for row in SQLite().execute("EXPLAIN QUERY PLAN " + statement,
+                                                            parameters)]
+            except sqlite3.Error:
+                pass
+
+        event = QueryEvent(model, operation, statement, parameters, duration,
+                           hydration, rows, plan)
+        with cls._lock:
+            key = (model._tablename, operation)
+            counters = cls._stats.setdefault(key, [0, 0.0, 0.0, 0])
+            counters[0] += 1
+            counters[1] += duration
+            counters[2] += hydration
+            counters[3] += max(rows, 0)
+            if cls._is_slow(duration):
+                cls.slow_queries.append(event)
+
+        for callback in cls._callbacks:
+            callback(event)
+
+    @classmethod
+    def _is_slow(cls, duration):
+        """Private method checking whether a duration is over the slow
+        query threshold.
+
+        """
+        return cls.slow_threshold is not None and duration >= cls.slow_threshold
+
+class InstrumentedCursor(object):
+    """A cursor of a SELECT run while the instrumentation is on. It adds up
+    the time spent fetching rows and the number of rows, and reports the
+    statement to Instrumentation when it is closed. Code turning the rows
+    into instances adds the time it spent to hydration.
+
+    Everything else is passed on to the wrapped cursor.
+
+    """
+
+    def __init__(self, model, cursor, statement, parameters, duration):
+        """Initialize the InstrumentedCursor with an executed cursor and the
+        time its execute took.
+
+        """
+        self.model = model
+        self.cursor = cursor
+        self.statement = statement
+        self.parameters = parameters
+        self.duration = duration
+        self.hydration = 0.0
+        self.rows = 0
+        self.closed = False
+
+    def fetchone(self):
+        start = time.time()
+        row = self.cursor.fetchone()
+        self.duration += time.time() - start
+        if row is not None:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.time()
+        rows = self.cursor.fetchmany(self.cursor.arraysize if size is None else size)
+        self.duration += time.time() - start
+        self.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        start = time.time()
+        rows = self.cursor.fetchall()
+        self.duration += time.time() - start
+        self.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        """Close the cursor and report the statement."""
+        if self.closed:
+            return
+        self.closed = True
+        self.cursor.close()
+        Instrumentation.record(self.model, "SELECT", self.statement, self.parameters,
+                               self.duration, self.rows, self.hydration)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
 class Field(object):
     """A simple basic database field descriptor that is used to
     map property of an object to a column in the database table.
@@ -98,7 +989,14 @@ class Field(object):
 
     The value of the descriptor is, incidentally, not stored in itself
     but inside the instance's __dict__. This is done because descriptors
-    are by nature singleton for all instances.
+    are by nature singleton for all instances. Instances of compact models
+    have no __dict__ and the value is instead stored in a slot of the
+    instance that belongs to the field, see ModelMeta.
+
+    Values loaded from the database are converted with from_db_format only
+    when they are first read. Until then instances keep the raw row in
+    _row, and compact instances keep the raw value in the slot with the bit
+    of the field set in _lazy.
 
     An excellent guide on this behavior and more detailed look into
     how it works can be found here: http://bit.ly/15gunlo
@@ -110,11 +1008,12 @@ class Field(object):
         allow_null: Specify whether current column allows null. Default: True.
         check: Specify whether sqlite should run check on current column.
         default: The default value this column will have.
+        indexed: Specify whether the column has an index.
 
     """
 
     def __init__(self, column_name=None, is_key=False, is_unique=False,
-            allow_null=True, check=False, default=None):
+            allow_null=True, check=False, default=None, indexed=False):
         """Initializes Field with specified options.
 
         Parameters:
@@ -127,6 +1026,8 @@ class Field(object):
             check: Boolean specifying whether to 'check' the field (see CHECK
                 in the SQLite documentation).
             default: The default value for the field.
+            indexed: Boolean specifying whether to create an index on the
+                column.
 
         """
         self.column_name = column_name
@@ -135,18 +1036,75 @@ class Field(object):
         self.allow_null = allow_null
         self.check = check
         self.default = default
+        self.indexed = indexed
         self.attr = None
 
+        #Set by ModelMeta. The position of the field in the model's _columns,
+        #whether the model is compact, the slot holding the value in compact
+        #instances and whether the field converts the values from the
+        #database, see ModelMeta.
+        self.index = None
+        self.compact = False
+        self.slot = None
+        self.lazy = False
+
     def __get__(self, instance, owner):
         """Get the current value from the instance's __dict__."""
         if instance == None:
             return self
 
-        return instance.__dict__[self.attr]
+        if self.compact:
+            if self.lazy and instance._lazy >> self.index & 1:
+                return self._decode(instance)
+            return self.slot.__get__(instance, owner)
+        try:
+            return instance.__dict__[self.attr]
+        except KeyError:
+            return self._decode(instance)
+
+    def _decode(self, instance):
+        """Private method that converts the raw value the instance was
+        loaded with, stores it as the value of the field and returns it.
+
+        """
+        if self.compact:
+            value = self.from_db_format(self.slot.__get__(instance, None))
+            self.slot.__set__(instance, value)
+            instance._lazy &= ~(1 << self.index)
+        else:
+            values = instance.__dict__
+            value = values[self.attr] = self.from_db_format(values["_row"][self.index])
+        return value
 
     def __set__(self, instance, value):
-        """Save the passed value to the instance's __dict__."""
-        instance.__dict__[self.attr] = self.validate(value)
+        """Save the passed value to the instance's __dict__ and mark the
+        field as changed if the value is different from the current one.
+
+        """
+        value = self.validate(value)
+        if self.compact:
+            if self.lazy and instance._lazy >> self.index & 1:
+                self._decode(instance)
+            try:
+                changed = self.slot.__get__(instance, None) != value
+            except AttributeError:
+                #The slot is empty until __init__ sets it.
+                changed = True
+            self.slot.__set__(instance, value)
+        else:
+            values, key = instance.__dict__, self.attr
+            if key not in values and "_row" in values:
+                self._decode(instance)
+            changed = key not in values or values[key] != value
+            values[key] = value
+
+        if changed:
+            #Loaded and saved instances all share the same empty frozenset
+            #until one of their fields is changed.
+            dirty = instance._dirty
+            if dirty is _clean:
+                dirty = instance._dirty = set()
+            dirty.add(self.attr)
 
     def validate(self, value):
         """Method to validate the value. This should be overridden
@@ -201,6 +1159,13 @@ class Field(object):
         """
         return value
 
+    def get_db_value(self, instance, first_time, is_query):
+        """Get the value of the field of an instance in the format it is
+        stored in the database, see to_db_format.
+
+        """
+        return self.to_db_format(self.__get__(instance, None), first_time, is_query)
+
     def _get_column_statement(self):
         """Private method used to get the column definition for the current field.
         Used for creating the field's column inside the database table.
@@ -226,7 +1191,7 @@ class Field(object):
             #Simple (ugly) check for how the default is formatted in
             #SQL statement.
             if isinstance(default, Number):
-                statement += default
+                statement += "%s" % default
             elif default == None:
                 statement += "%s" % default
             else:
@@ -279,6 +1244,18 @@ class FieldDecimal(Field):
         from decimal import Decimal as D
         return D(value)
 
+    def from_db_format(self, value):
+        """Override the parent from_db_format and turn the int or float
+        sqlite returns for a NUMERIC column back into a decimal.
+
+        """
+        from decimal import Decimal as D
+        if value is None or isinstance(value, D):
+            return value
+        #Go through str so a float comes back as the value it was saved as
+        #and not its binary approximation.
+        return D(str(value))
+
 class FieldText(Field):
     """A Database Field to hold normal text.
 
@@ -308,13 +1285,21 @@ class FieldDateTime(Field):
     Inherits most of the functionality from Field
     and only overrides some of the default configuration.
 
+    By default the value is stored as text in the fixed format
+    YYYY-MM-DD HH:MM:SS.ffffff. With storage="epoch" it is instead stored
+    as an integer count of microseconds since 1970-01-01, which takes less
+    space and compares faster in ORDER BY and range lookups. Time zones
+    aren't taken into account in either case.
+
     """
 
-    def __init__(self, auto_now=False, auto_now_add=False, *args, **kwargs):
+    def __init__(self, auto_now=False, auto_now_add=False, storage="text", *args, **kwargs):
         """Initialises the FieldDateTime."""
-        import datetime
+        if storage not in ("text", "epoch"):
+            raise ValueError("Unknown datetime storage %s. Use one of text, epoch." % storage)
 
-        self.column_type = "TEXT"
+        self.column_type = "INTEGER" if storage == "epoch" else "TEXT"
+        self.storage = storage
         self.auto_now = auto_now
         self.auto_now_add = auto_now_add
 
@@ -328,8 +1313,6 @@ class FieldDateTime(Field):
         will always turn into a text (string).
 
         """
-        import datetime
-
         if isinstance(value, datetime.datetime):
             return value
         else:
@@ -338,81 +1321,237 @@ class FieldDateTime(Field):
 
     def to_db_format(self, value, first_time, is_query):
         """Override the to_db_format to convert the datetime.datetime
-        value to string.
+        value to string, or to microseconds for epoch storage.
 
         """
-        import datetime
-
         #Override the value if either auto_now is specified or auto_now_add
         #is specified and it is a new item.
         if is_query and (self.auto_now or (first_time and self.auto_now_add)):
             value = datetime.datetime.now()
-        return datetime.datetime.strftime(value, "%Y-%m-%d %H:%M:%S.%f")
+
+        if self.storage == "epoch":
+            delta = value - _epoch
+            return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+        #Formatted by hand rather than with strftime, which refuses years
+        #before 1900 on python 2 and doesn't pad years to four digits.
+        return "%04d-%02d-%02d %02d:%02d:%02d.%06d" % (
+            value.year, value.month, value.day,
+            value.hour, value.minute, value.second, value.microsecond)
 
     def from_db_format(self, value):
         """Override the from_db_format from field to convert the string
         from the database to a datetime.datetime object.
 
         """
-        import datetime
-
+        if self.storage == "epoch":
+            return _epoch + datetime.timedelta(microseconds=value)
+
+        #Values written by to_db_format always have the same length and
+        #can be sliced apart, which is a lot faster than strptime. Anything
+        #else, like text written by hand, still goes through strptime.
+        if len(value) == 26:
+            try:
+                return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                         int(value[11:13]), int(value[14:16]),
+                                         int(value[17:19]), int(value[20:26]))
+            except ValueError:
+                pass
         return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
 
+#The start of epoch storage of FieldDateTime.
+_epoch = datetime.datetime(1970, 1, 1)
 
-class ModelMeta(type):
-    """The meta class for the model class used to properly Initialize
-    the fields for the models as well as doing other checks.
-
-    For sql, the meta class creates static variables inside
-    the model class for easier lookuping on column names and such.
+class _Dangling(object):
+    """Kept by a FieldForeignKey in place of a related instance that doesn't
+    exist, holding the primary key the field stores.
 
     """
 
-    def __new__(cls, name, bases, dct):
-        """Initialize the new model and add appropriate static variables
-        to it.
+    __slots__ = ("key",)
 
-        Among the things it does, it adds private properties containing the
-        name of the primary key, the column names and table name as well
-        as few other handy private variables.
+    def __init__(self, key):
+        self.key = key
 
-        It also scans each field belonging in the class and initializes them
-        appropriately. If a primary key field is not found, one is created
-        automatically with the default sqlite id column name (_rowid_).
+class FieldForeignKey(Field):
+    """A Database Field holding the primary key of an instance of another
+    model, which it returns in its place.
 
-        """
+    The related instance is only loaded with get the first time the field
+    is read, after which it is kept. So is a related row that doesn't
+    exist, which isn't looked up again. Query sets can load the related
+    instances of many rows at once instead, with a JOIN using
+    select_related or with one IN query per chunk using prefetch_related.
 
-        #Initialize and/or override some of the static class variables
-        #inside the class
-        dct["_columns"] = []
-        dct["_tablename"] = None
-        dct["_primary_key"] = None
-        dct['_tablename'] = name
+    The column is indexed by default. Either an instance or a primary key
+    can be assigned to the field and used in filters.
 
-        found_primary = False
+    Example:
+        class orders(Model):
+            customer = FieldForeignKey(customer)
 
-        #dct contains a list of all the attributes inside the current model
-        #class so we can effectively loop through it and chech which ones are
-        #fiels and initialize them appropriately.
-        for attr, value in dct.items():
-            if isinstance(value, Field):
-                #We need to store the attribute name the descriptor is
-                #attached as so it can safely store the value inside the
-                #instance __dict__ among other things.
-                value.attr = attr
+        for x in orders.filter().select_related("customer"):
+            print(x.customer.name)
 
-                if value.column_name == None:
-                    #By default, we turn the column name of the field to
-                    #the attribute name if none is specified.
-                    value.column_name = attr
+    """
 
-                if value.is_key:
-                    if found_primary:
-                        #SQLite only supports a single primary key.
-                        raise TypeError("Expected a single primary key Field" +
-                                        " but found two.")
+    def __init__(self, model, *args, **kwargs):
+        """Initialises the FieldForeignKey.
 
-                    #Mark that a field belonging as the primary key was found
+        Parameters:
+            model: The related model class, or its name for a model that is
+                defined later on.
+
+        """
+        self._related = model
+        kwargs.setdefault('indexed', True)
+        super(FieldForeignKey, self).__init__(*args, **kwargs)
+
+    @property
+    def related(self):
+        """The related model class."""
+        if not isinstance(self._related, type):
+            self._related = ModelMeta.models[self._related]
+        return self._related
+
+    @property
+    def column_type(self):
+        """The column has the type of the primary key of the related model."""
+        related = self.related
+        return related._field_by_column[related._primary_key].column_type
+
+    def __get__(self, instance, owner):
+        """Get the related instance, loading it if it hasn't been loaded."""
+        value = super(FieldForeignKey, self).__get__(instance, owner)
+        if instance is None or value is None or isinstance(value, Model):
+            return value
+        if isinstance(value, _Dangling):
+            return None
+
+        related = self.related.get(value)
+        self._store(instance, _Dangling(value) if related is None else related)
+        return related
+
+    def _get_stored(self, instance):
+        """Private method getting the primary key or related instance held
+        by the instance, without loading anything.
+
+        """
+        if self.compact:
+            return self.slot.__get__(instance, None)
+        return instance.__dict__.get(self.attr)
+
+    def _store(self, instance, related):
+        """Private method keeping the loaded related instance in place of
+        its primary key. The field doesn't count as changed.
+
+        """
+        if self.compact:
+            self.slot.__set__(instance, related)
+        else:
+            instance.__dict__[self.attr] = related
+
+    def validate(self, value):
+        """Override the parent validate and make sure instances assigned to
+        the field belong to the related model.
+
+        """
+        if isinstance(value, Model) and not isinstance(value, self.related):
+            raise TypeError("Attempted to assign an instance of %s to a foreign key of %s." %
+                            (value.__class__.__name__, self.related.__name__))
+        return value
+
+    def to_db_format(self, value, first_time, is_query):
+        """Override the to_db_format to store the primary key of related
+        instances.
+
+        """
+        if isinstance(value, Model):
+            return getattr(value, value._primary_key)
+        if isinstance(value, _Dangling):
+            return value.key
+        return value
+
+    def get_db_value(self, instance, first_time, is_query):
+        """Override the get_db_value so the related instance isn't loaded
+        just to get its primary key.
+
+        """
+        return self.to_db_format(self._get_stored(instance), first_time, is_query)
+
+#The shared _dirty of instances without changes, and a marker for values
+#that haven't been set.
+_clean = frozenset()
+_unset = object()
+
+#The from_db_format and to_db_format of the base Field return the value
+#untouched. Fields that don't override them can skip the call completely.
+_no_conversion = Field.__dict__["from_db_format"]
+_no_db_conversion = Field.__dict__["to_db_format"]
+
+class ModelMeta(type):
+    """The meta class for the model class used to properly Initialize
+    the fields for the models as well as doing other checks.
+
+    For sql, the meta class creates static variables inside
+    the model class for easier lookuping on column names and such.
+
+    Every model is registered in models, by table name, so check_db can
+    create their tables. Classes that set __abstract__ to True, like Model
+    itself, don't have a table and are left out.
+
+    Attributes:
+        models: Ordered dictionary of the table names and models.
+
+    """
+
+    models = collections.OrderedDict()
+
+    def __new__(cls, name, bases, dct):
+        """Initialize the new model and add appropriate static variables
+        to it.
+
+        Among the things it does, it adds private properties containing the
+        name of the primary key, the column names and table name as well
+        as few other handy private variables.
+
+        It also scans each field belonging in the class and initializes them
+        appropriately. If a primary key field is not found, one is created
+        automatically with the default sqlite id column name (_rowid_).
+
+        """
+
+        #Initialize and/or override some of the static class variables
+        #inside the class
+        dct["_columns"] = []
+        dct["_tablename"] = None
+        dct["_primary_key"] = None
+        dct['_tablename'] = name
+
+        found_primary = False
+
+        #dct contains a list of all the attributes inside the current model
+        #class so we can effectively loop through it and chech which ones are
+        #fiels and initialize them appropriately.
+        for attr, value in dct.items():
+            if isinstance(value, Field):
+                #We need to store the attribute name the descriptor is
+                #attached as so it can safely store the value inside the
+                #instance __dict__ among other things.
+                value.attr = attr
+
+                if value.column_name == None:
+                    #By default, we turn the column name of the field to
+                    #the attribute name if none is specified.
+                    value.column_name = attr
+
+                if value.is_key:
+                    if found_primary:
+                        #SQLite only supports a single primary key.
+                        raise TypeError("Expected a single primary key Field" +
+                                        " but found two.")
+
+                    #Mark that a field belonging as the primary key was found
                     #and store the column name for it.
                     found_primary = True
                     dct["_primary_key"] = value.column_name
@@ -431,9 +1570,86 @@ class ModelMeta(type):
             #field here and add it to the class.
             dct["_columns"].insert(0, "_rowid_")
             dct["_primary_key"] = "_rowid_"
-            dct["_rowid_"] = FieldInteger(is_key=True)
-
-        return super(ModelMeta, cls).__new__(cls, name, bases, dct)
+            dct["_rowid_"] = FieldInteger("_rowid_", is_key=True)
+            dct["_rowid_"].attr = "_rowid_"
+
+        #Used to quickly validate column names in queries.
+        dct["_column_set"] = frozenset(dct["_columns"])
+
+        #Holds the sql statements generated for the model, see _build_query.
+        dct["_statements"] = {}
+
+        #Models can opt in to caching instances returned by get.
+        dct["_cache"] = None
+        if dct.get("__cache_size__"):
+            dct["_cache"] = ModelCache(dct["__cache_size__"],
+                                       dct.get("__cache_ttl__"))
+
+        #Precompute everything needed to turn a row into an instance so
+        #_result_to_model doesn't have to search for the field of each
+        #column for every row. _fields holds the fields in the same order
+        #as _columns, _attrs their attribute names and _conversions only
+        #the (index, attribute, from_db_format) of fields that actually
+        #convert the value coming from the database. Those fields are
+        #lazy, their values are only converted when they are read, so
+        #_plain_attrs and _plain_values are the attribute names and a
+        #getter of the values of the other fields.
+        fields = dict((value.column_name, value) for value in dct.values()
+                      if isinstance(value, Field))
+        dct["_fields"] = tuple(fields[column] for column in dct["_columns"])
+        dct["_field_by_column"] = fields
+
+        #Compact models keep the value of each field in a slot of its own,
+        #named after the position of the field, instead of a __dict__. With
+        #__slots__ the instances don't have a __dict__ at all, which saves
+        #memory when holding many of them.
+        dct["_compact"] = bool(dct.get("__compact__"))
+        if dct["_compact"]:
+            dct["__slots__"] = ("_lazy", "_saved", "_dirty") + tuple(
+                "_value%d" % i for i in range(len(dct["_fields"])))
+        for i, field in enumerate(dct["_fields"]):
+            field.index = i
+            field.compact = dct["_compact"]
+        dct["_attrs"] = tuple(field.attr for field in dct["_fields"])
+        dct["_conversions"] = tuple(
+            (i, field.attr, field.from_db_format)
+            for i, field in enumerate(dct["_fields"])
+            if getattr(field.from_db_format, "__func__", None) is not _no_conversion)
+        plain = [i for i, field in enumerate(dct["_fields"])
+                 if getattr(field.from_db_format, "__func__", None) is _no_conversion]
+        dct["_plain_attrs"] = tuple(dct["_attrs"][i] for i in plain)
+        dct["_plain_values"] = staticmethod(
+            operator.itemgetter(*plain) if len(plain) > 1 else
+            lambda row, plain=plain: tuple(row[i] for i in plain))
+        dct["_lazy_mask"] = 0
+        for i, attr, convert in dct["_conversions"]:
+            dct["_fields"][i].lazy = True
+            dct["_lazy_mask"] |= 1 << i
+
+        #Indexes of the model, both of indexed fields and the ones listed in
+        #__indexes__. The columns are checked here so a typo fails early.
+        dct["_indexes"] = tuple(
+            [Index(field.column_name) for field in dct["_fields"] if field.indexed] +
+            list(dct.get("__indexes__", ())))
+        for index in dct["_indexes"]:
+            for column in index.columns:
+                if column not in dct["_column_set"]:
+                    raise TypeError("Index on unknown column %s. Model only supports columns %s." %
+                                    (column, ', '.join(dct["_columns"])))
+
+        model = super(ModelMeta, cls).__new__(cls, name, bases, dct)
+
+        #The fields of compact models read and write their slot through its
+        #descriptor, _slots are all of them in the order of _columns.
+        model._slots = ()
+        if model._compact:
+            for i, field in enumerate(model._fields):
+                field.slot = model.__dict__["_value%d" % i]
+            model._slots = tuple(field.slot for field in model._fields)
+
+        if not dct.get("__abstract__"):
+            cls.models[dct["_tablename"]] = model
+        return model
 
 class class_or_instance(object):
     """A descriptor that allows a function to both be called with an
@@ -444,55 +1660,1093 @@ class class_or_instance(object):
         """Initialize the descriptor."""
         self.func = func
 
-    def __get__(self, instance, owner):
-        """When called, calls the function it's tied to with the instance
-        if called from within an instance, otherwise calls it with the owner
-        class type.
+    def __get__(self, instance, owner):
+        """When called, calls the function it's tied to with the instance
+        if called from within an instance, otherwise calls it with the owner
+        class type.
+
+        """
+        return functools.partial(self.func, instance if instance else owner)
+
+#The sql expression for each lookup that can be added to the end of a column
+#name in filters. "in" and "isnull" are built in Model._compile_lookup.
+_lookups = {
+    "exact": "%s = ?",
+    "ne": "%s != ?",
+    "gt": "%s > ?",
+    "gte": "%s >= ?",
+    "lt": "%s < ?",
+    "lte": "%s <= ?",
+    "range": "%s BETWEEN ? AND ?",
+    "startswith": "%s GLOB ?",
+    "istartswith": "%s LIKE ? ESCAPE '\\'",
+}
+
+def _split_lookup(key):
+    """Split a filter name such as "id__gt" into the column name and the
+    lookup. Names without a known lookup are plain equality.
+
+    Returns:
+        A tuple with the column name and the lookup.
+
+    """
+    column, _, lookup = key.rpartition("__")
+    if column and (lookup in _lookups or lookup in ("in", "isnull")):
+        return column, lookup
+    return key, "exact"
+
+def _lookup_shape(key, value):
+    """Get the part of a lookup the sql statement depends on. That is the name
+    alone, except for "__in" where the number of values matters and
+    "__isnull" where the value decides between IS NULL and IS NOT NULL.
+
+    """
+    if key.endswith("__in"):
+        return (key, len(value))
+    if key.endswith("__isnull"):
+        return (key, bool(value))
+    return key
+
+def _escape_glob(value):
+    """Escape the wildcards of a GLOB pattern so the value matches as is."""
+    return ("%s" % value).replace("[", "[[]").replace("*", "[*]").replace("?", "[?]")
+
+def _escape_like(value):
+    """Escape the wildcards of a LIKE pattern so the value matches as is."""
+    return ("%s" % value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+class Q(object):
+    """A group of lookups used to build more complicated filters. Groups can
+    be combined with & (AND) and | (OR) and negated with ~ (NOT).
+
+    Example:
+        car.filter(Q(make="Opel") | Q(make="BMW", wheels__gt=4))
+
+    The lookups supported at the end of the column names are:
+        exact: Equal to the value. Same as giving the column name alone.
+        ne: Not equal to the value.
+        gt, gte, lt, lte: Greater than, greater than or equal, less than and
+            less than or equal to the value.
+        in: Equal to any of the values in a list.
+        range: Between the two values of a (low, high) tuple, inclusive.
+        isnull: Is NULL if the value is True, otherwise IS NOT NULL.
+        startswith: Starts with the value, case sensitive.
+        istartswith: Starts with the value, ignoring case for ASCII letters.
+
+    All values are converted with the to_db_format of the field before
+    they are sent to the database.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Create a group with the lookups ANDed together.
+
+        Parameters:
+            *args: Other Q objects to include in the group.
+            **kwargs: Named lookups and their values.
+
+        """
+        self.connector = "AND"
+        self.negated = False
+
+        #The named lookups are sorted so the same lookups always give the
+        #same statement, no matter what order they came in.
+        self.children = list(args) + sorted(kwargs.items())
+
+    def _combine(self, other, connector):
+        """Combine the group with another one using the connector."""
+        if not isinstance(other, Q):
+            raise TypeError("Can only combine a Q object with another Q object.")
+        if not other.children:
+            return self
+        if not self.children:
+            return other
+
+        combined = Q()
+        combined.connector = connector
+        combined.children = [self, other]
+        return combined
+
+    def __and__(self, other):
+        return self._combine(other, "AND")
+
+    def __or__(self, other):
+        return self._combine(other, "OR")
+
+    def __invert__(self):
+        negated = Q()
+        negated.children = [self]
+        negated.negated = True
+        return negated
+
+    def _flatten(self, values):
+        """Get the shape of the group and add the values of its lookups to
+        values, in the order they appear in the statement.
+
+        Parameters:
+            values: List to add the values of the lookups to.
+
+        Returns:
+            A (connector, negated, children) tuple where each child is the
+            shape of a lookup (see _lookup_shape) or of a group.
+
+        """
+        shapes = []
+        for child in self.children:
+            if isinstance(child, Q):
+                shapes.append(child._flatten(values))
+            else:
+                key, value = child
+                shapes.append(_lookup_shape(key, value))
+                values.append(value)
+        return (self.connector, self.negated, tuple(shapes))
+
+Page = collections.namedtuple("Page", "items next")
+class QuerySet(object):
+    """A lazy query on a model's table, returned by Model.filter.
+
+    Nothing is sent to the database until the query set is iterated. Rows
+    are then fetched chunk_size at a time with fetchmany and turned into
+    model instances as they are iterated, so going over a large table only
+    keeps a single chunk in memory.
+
+    Query sets can be chained with filter, order_by, limit and offset and
+    sliced. Filters can use lookups and Q objects (see Q). Everything is
+    turned into a single parameterized SELECT, with slicing turned into
+    LIMIT and OFFSET.
+
+    Example:
+        for x in car.filter(wheels__gte=4).order_by("-made")[100:200]:
+            print x
+
+    Attributes:
+        model: The model class the query set belongs to.
+        chunk_size: Number of rows fetched from the cursor at a time.
+
+    """
+
+    chunk_size = 100
+
+    def __init__(self, model, where=None):
+        """Initialize the query set.
+
+        Parameters:
+            model: The model class to query.
+            where: A Q object or a dict containing the named fields and
+                values to match.
+
+        """
+        self.model = model
+        self._where = where if isinstance(where, Q) else Q(**(where or {}))
+        self._order_by = ()
+        self._group_by = ()
+        self._limit = None
+
+        #A (columns, kind, convert) tuple when the query set returns plain
+        #values instead of instances, see values and values_list.
+        self._projection = None
+        self._offset = 0
+
+        #Foreign keys whose instances are loaded with the query, see
+        #select_related and prefetch_related.
+        self._select_related = ()
+        self._prefetch_related = ()
+
+        #Only used when the query set has to know all of its results, for
+        #example when len() is called on it. Normal iteration streams the
+        #rows and never fills this.
+        self._result_cache = None
+
+    def _clone(self):
+        """Return a copy of the query set without any cached results."""
+        clone = self.__class__(self.model, self._where)
+        clone._order_by = self._order_by
+        clone._group_by = self._group_by
+        clone._projection = self._projection
+        clone._select_related = self._select_related
+        clone._prefetch_related = self._prefetch_related
+        clone._limit = self._limit
+        clone._offset = self._offset
+        clone.chunk_size = self.chunk_size
+        return clone
+
+    def filter(self, *args, **kwargs):
+        """Return a new query set further limited by the named parameters.
+
+        Parameters:
+            *args: Q objects the objects have to match.
+            **kwargs: Named fields and values of objects to search for. The
+                names can end with a lookup, see Q.
+
+        Returns:
+            A new QuerySet matching both the current and the new parameters.
+
+        """
+        if self._limit is not None or self._offset:
+            raise TypeError("Cannot filter a query once a slice has been taken.")
+
+        clone = self._clone()
+        clone._where = self._where & Q(*args, **kwargs)
+        return clone
+
+    def update(self, **values):
+        """Update every matching row with a single UPDATE, without loading
+        any of them. The values are validated and converted by their fields
+        like on save, and auto_now fields are set to the current time.
+
+        Like save, the update is commited straight away unless it runs
+        inside a transaction block. Instances already loaded are not
+        changed and the model's cache is emptied.
+
+        Parameters:
+            **values: Names of the columns and their new values.
+
+        Returns:
+            The number of updated rows.
+
+        """
+        self._check_unsliced("update")
+        model = self.model
+
+        data = {}
+        for column, value in values.items():
+            field = model._check_column(column)
+            data[column] = field.to_db_format(field.validate(value), False, True)
+        for field in model._fields:
+            if getattr(field, "auto_now", False) and field.column_name not in data:
+                data[field.column_name] = field.to_db_format(field.default, False, True)
+        if not data:
+            raise TypeError("Expected at least one column to update.")
+
+        cursor = model._generate_query("UPDATE", where=self._where, data=data)
+        count = cursor.rowcount
+        cursor.close()
+
+        #There is no knowing which of the cached instances were changed.
+        if model._cache is not None:
+            model._cache.clear()
+        return count
+
+    def delete(self):
+        """Delete every matching row with a single DELETE, without loading
+        any of them. Like Model.delete, it is commited straight away unless
+        it runs inside a transaction block.
+
+        Returns:
+            The number of deleted rows.
+
+        """
+        self._check_unsliced("delete")
+        model = self.model
+
+        cursor = model._generate_query("DELETE", where=self._where)
+        count = cursor.rowcount
+        cursor.close()
+
+        #There is no knowing which of the cached instances were deleted.
+        if model._cache is not None:
+            model._cache.clear()
+        return count
+
+    def _check_unsliced(self, action):
+        """Make sure no slice has been taken of the query, since sqlite can't
+        apply a LIMIT or OFFSET to an UPDATE or DELETE.
+
+        """
+        if self._limit is not None or self._offset:
+            raise TypeError("Cannot %s a query once a slice has been taken." % action)
+
+    def select_related(self, *fields):
+        """Return a new query set that loads the related instances of the
+        foreign keys in the same query, with a LEFT JOIN on each of their
+        tables.
+
+        Parameters:
+            *fields: Attribute names of FieldForeignKey fields.
+
+        """
+        clone = self._clone()
+        clone._select_related = self._select_related + self._foreign_keys(fields)
+        return clone
+
+    def prefetch_related(self, *fields):
+        """Return a new query set that loads the related instances of the
+        foreign keys with one extra query per foreign key for every chunk
+        of rows, using IN on the primary keys in the chunk.
+
+        Parameters:
+            *fields: Attribute names of FieldForeignKey fields.
+
+        """
+        clone = self._clone()
+        clone._prefetch_related = self._prefetch_related + self._foreign_keys(fields)
+        return clone
+
+    def _foreign_keys(self, fields):
+        """Get the FieldForeignKey fields with the attribute names."""
+        result = []
+        for attr in fields:
+            field = self.model.__dict__.get(attr)
+            if not isinstance(field, FieldForeignKey):
+                raise TypeError("Found unknown foreign key %s." % attr)
+            result.append(field)
+        return tuple(result)
+
+    def _select_related_query(self):
+        """A hidden method that builds the SELECT of select_related. The
+        query of the query set goes in a subquery, which is joined with
+        the tables of the related models.
+
+        Returns:
+            A tuple with the statement, its parameters and a function that
+            turns each row into an instance along with its related ones.
+
+        """
+        model = self.model
+        inner, parameters = model._build_query("SELECT", self._where,
+                                               limit=self._limit,
+                                               offset=self._offset,
+                                               order_by=self._order_by)
+
+        columns = ["t.%s" % x for x in model._columns]
+        joins = []
+        spans = []
+        for i, field in enumerate(self._select_related):
+            related, alias = field.related, "r%d" % i
+            start = len(columns)
+            columns.extend("%s.%s" % (alias, x) for x in related._columns)
+            joins.append(" LEFT JOIN %s AS %s ON %s.%s = t.%s" % (
+                related._tablename, alias, alias, related._primary_key,
+                field.column_name))
+            spans.append((field, related, start, len(columns),
+                          start + related._columns.index(related._primary_key)))
+
+        #The order of the subquery doesn't carry over to the join.
+        order = ', '.join(["t.%s DESC" % x[1:] if x.startswith("-") else "t.%s ASC" % x
+                           for x in self._order_by])
+        statement = "SELECT %s FROM (%s) AS t%s%s" % (', '.join(columns), inner,
+                                                      ''.join(joins),
+                                                      " ORDER BY " + order if order else "")
+
+        count = len(model._columns)
+        def make(row):
+            instance = model._result_to_model(row[:count])
+            for field, related, start, end, key in spans:
+                #Rows that point to nothing keep their key as dangling.
+                if row[key] is not None:
+                    field._store(instance, related._result_to_model(row[start:end]))
+                elif row[field.index] is not None:
+                    field._store(instance, _Dangling(row[field.index]))
+            return instance
+
+        return statement, parameters, make
+
+    def _prefetch(self, instances):
+        """A hidden method that loads the related instances of the
+        prefetch_related foreign keys of the instances, with one query per
+        foreign key.
+
+        """
+        for field in self._prefetch_related:
+            related = field.related
+            keys = set()
+            for x in instances:
+                key = field._get_stored(x)
+                if key is not None and not isinstance(key, (Model, _Dangling)):
+                    keys.add(key)
+            if not keys:
+                continue
+
+            found = related.filter(**{related._primary_key + "__in": list(keys)})
+            found = dict((getattr(x, related._primary_key), x) for x in found)
+            for x in instances:
+                key = field._get_stored(x)
+                if key in found:
+                    field._store(x, found[key])
+                elif key in keys:
+                    field._store(x, _Dangling(key))
+
+    def iter_chunks(self, chunk_size=1000, order_by=None):
+        """Generator that walks the matching rows in lists of chunk_size
+        instances, using keyset paging. Every chunk is a query of its own
+        that continues after the last row of the previous chunk with
+        WHERE key > ? ORDER BY key LIMIT ?, so each chunk costs the same no
+        matter how deep into the table it is, unlike OFFSET.
+
+        Rows added or removed while walking don't make it skip or repeat
+        other rows.
+
+        Parameters:
+            chunk_size: Number of instances in each chunk.
+            order_by: Name of the column to walk the rows by, starting with
+                "-" for descending order. Rows with the same value are
+                ordered by primary key. The column can't hold NULLs.
+                Defaults to the primary key, or _rowid_ for models without
+                one.
+
+        """
+        after = None
+        while True:
+            chunk = list(self._keyset(after, order_by)[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after = self._keyset_cursor(chunk[-1], order_by)
+
+    def paginate(self, after=None, limit=100, order_by=None):
+        """Get a page of the matching rows using keyset paging, see
+        iter_chunks.
+
+        Parameters:
+            after: The next of the previous page, or None for the first.
+            limit: Number of instances in a page.
+            order_by: Name of the column to page by, see iter_chunks.
+
+        Returns:
+            A Page named tuple with the list of instances and what to pass
+            as after to get the next page, or None if it's the last page.
+
+        """
+        items = list(self._keyset(after, order_by)[:limit + 1])
+        if len(items) <= limit:
+            return Page(items, None)
+        items = items[:limit]
+        return Page(items, self._keyset_cursor(items[-1], order_by))
+
+    def _keyset(self, after, order_by):
+        """A hidden method that gets the query set of the rows after the
+        cursor in keyset order.
+
+        Parameters:
+            after: The primary key of the last row, a tuple of the value of
+                the order_by column and the primary key when ordering by
+                another column, or None to start at the beginning.
+            order_by: Name of the column to order by, or None.
+
+        """
+        self._check_unsliced("page through")
+        key = self.model._primary_key
+        column = order_by or key
+        descending = column.startswith("-")
+        name = self._column(column.lstrip("-"))
+        lookup = "__lt" if descending else "__gt"
+
+        if name == key:
+            where = Q(**{key + lookup: after}) if after is not None else Q()
+            return self.filter(where).order_by(column)
+
+        where = Q()
+        if after is not None:
+            where = Q(**{"%s,%s%s" % (name, key, lookup): tuple(after)})
+        return self.filter(where).order_by(column, ("-" if descending else "") + key)
+
+    def _keyset_cursor(self, instance, order_by):
+        """A hidden method that gets the cursor of the rows after the
+        instance, see _keyset.
+
+        """
+        model = self.model
+        key = model._field_by_column[model._primary_key].attr
+        name = (order_by or model._primary_key).lstrip("-")
+        if name == model._primary_key:
+            return getattr(instance, key)
+        attr = model._field_by_column[name].attr
+        return (getattr(instance, attr), getattr(instance, key))
+
+    def order_by(self, *columns):
+        """Return a new query set ordered by the columns, replacing any
+        previous ordering.
+
+        Parameters:
+            *columns: Names of the columns to order by. Names starting with
+                "-" are in descending order.
+
+        """
+        clone = self._clone()
+        clone._order_by = columns
+        return clone
+
+    def limit(self, count):
+        """Return a new query set returning at most count objects. Unlike
+        slicing, this sets the LIMIT as is, regardless of the offset.
+
+        """
+        clone = self._clone()
+        clone._limit = count
+        return clone
+
+    def offset(self, count):
+        """Return a new query set skipping the first count objects. Unlike
+        slicing, this sets the OFFSET as is, regardless of the limit.
+
+        """
+        clone = self._clone()
+        clone._offset = count
+        return clone
+
+    def values(self, *columns, **kwargs):
+        """Return a new query set that returns a dict for each row instead of
+        a model instance. Only the requested columns are selected and only
+        their values are converted.
+
+        Parameters:
+            *columns: Names of the columns to return. Defaults to all.
+            convert: Boolean specifying whether to convert the values with
+                the from_db_format of the fields. Default: True.
+
+        Example:
+            >>> list(car.filter().values("id", "make"))
+            [{'id': 1, 'make': u'Opel'}, {'id': 3, 'make': u'BMW'}]
+
+        """
+        return self._project(columns, "dict", kwargs)
+
+    def values_list(self, *columns, **kwargs):
+        """Return a new query set that returns a tuple for each row instead
+        of a model instance. Only the requested columns are selected and only
+        their values are converted.
+
+        Parameters:
+            *columns: Names of the columns to return. Defaults to all.
+            flat: Return the value alone instead of a tuple. Only allowed
+                with a single column.
+            named: Return named tuples instead of plain tuples. Columns that
+                are not valid names, such as _rowid_, are renamed.
+            convert: Boolean specifying whether to convert the values with
+                the from_db_format of the fields. Without conversion, the
+                rows are returned exactly as sqlite3 returns them.
+                Default: True.
+
+        Example:
+            >>> list(car.filter().values_list("id", flat=True))
+            [1, 3]
+
+        """
+        flat = kwargs.pop("flat", False)
+        named = kwargs.pop("named", False)
+        if flat and named:
+            raise TypeError("values_list can't be both flat and named.")
+        if flat and len(columns) != 1:
+            raise TypeError("values_list can only be flat with a single column.")
+        return self._project(columns, "flat" if flat else "namedtuple" if named else "tuple",
+                             kwargs)
+
+    def _project(self, columns, kind, kwargs):
+        """A hidden method that returns a new query set returning the columns
+        as the kind of values, for values and values_list.
+
+        """
+        convert = kwargs.pop("convert", True)
+        if kwargs:
+            raise TypeError("Unknown option %s." % ', '.join(kwargs))
+
+        columns = tuple(self._column(x) for x in columns) or tuple(self.model._columns)
+        clone = self._clone()
+        clone._projection = (columns, kind, convert)
+        return clone
+
+    def _row_factory(self):
+        """A hidden method that gets what the query should select and how
+        to turn each row into what the query set returns.
+
+        Returns:
+            A tuple with the sql expressions to select, or None for all the
+            columns, and a function to call with each row, or None if the
+            rows are returned as they are.
+
+        """
+        if self._projection is None:
+            return None, self.model._result_to_model
+
+        columns, kind, convert = self._projection
+
+        conversions = []
+        if convert:
+            for i, column in enumerate(columns):
+                from_db_format = self.model._field_by_column[column].from_db_format
+                if getattr(from_db_format, "__func__", None) is not _no_conversion:
+                    conversions.append((i, from_db_format))
+
+        if conversions:
+            def values(row):
+                row = list(row)
+                for i, from_db_format in conversions:
+                    if row[i] is not None:
+                        row[i] = from_db_format(row[i])
+                return row
+        else:
+            values = None
+
+        if kind == "flat":
+            if values is None:
+                return columns, operator.itemgetter(0)
+            return columns, lambda row: values(row)[0]
+        elif kind == "tuple":
+            if values is None:
+                return columns, None
+            return columns, lambda row: tuple(values(row))
+        elif kind == "namedtuple":
+            make = collections.namedtuple(self.model._tablename, columns, rename=True)._make
+        else:
+            make = lambda row: dict(zip(columns, row))
+
+        if values is None:
+            return columns, make
+        return columns, lambda row: make(values(row))
+
+    def group_by(self, *columns):
+        """Return a new query set whose aggregates (count, sum, min, max and
+        avg) are computed for each group of rows with the same values in
+        the columns. The aggregates then return a list of tuples with the
+        values of the columns followed by the aggregate.
+
+        Example:
+            >>> car.filter().group_by("make").count()
+            [(u'BMW', 2), (u'Opel', 5)]
+
+        """
+        clone = self._clone()
+        clone._group_by = columns
+        return clone
+
+    def count(self):
+        """Count the matching rows with a single SELECT COUNT(*), without
+        loading any of them.
+
+        """
+        return self._aggregate("COUNT(*)")
+
+    def exists(self):
+        """Check whether the query has any results, fetching at most a
+        single row and not loading it as an instance.
+
+        """
+        query = self[:1]
+        cursor = self.model._generate_query("SELECT", where=query._where,
+                                            limit=query._limit,
+                                            offset=query._offset,
+                                            select=("1",))
+        try:
+            return cursor.fetchone() is not None
+        finally:
+            cursor.close()
+
+    def sum(self, column):
+        """Get the sum of the column over the matching rows."""
+        return self._aggregate("SUM(%s)" % self._column(column))
+
+    def avg(self, column):
+        """Get the average of the column over the matching rows."""
+        return self._aggregate("AVG(%s)" % self._column(column))
+
+    def min(self, column):
+        """Get the smallest value of the column over the matching rows,
+        converted with the from_db_format of the field.
+
+        """
+        field = self.model._field_by_column[self._column(column)]
+        return self._aggregate("MIN(%s)" % column, field.from_db_format)
+
+    def max(self, column):
+        """Get the largest value of the column over the matching rows,
+        converted with the from_db_format of the field.
+
+        """
+        field = self.model._field_by_column[self._column(column)]
+        return self._aggregate("MAX(%s)" % column, field.from_db_format)
+
+    def _column(self, column):
+        """Make sure the column belongs to the model and return it."""
+        self.model._check_column(column)
+        return column
+
+    def _aggregate(self, expression, convert=None):
+        """A hidden method that runs a single SELECT for the aggregate
+        expression.
+
+        Parameters:
+            expression: The sql aggregate expression, such as "COUNT(*)".
+            convert: Function to convert the result with or None.
+
+        Returns:
+            The value of the aggregate, or when grouped, a list of tuples
+            with the values of the group columns and the aggregate.
+
+        """
+        model = self.model
+        group_by = self._group_by
+
+        if (self._limit is not None or self._offset) and not group_by:
+            #The LIMIT and OFFSET have to pick the rows the aggregate is
+            #computed over and not limit the single row of the result, so
+            #the sliced query has to go in a subquery.
+            inner, parameters = model._build_query("SELECT", self._where,
+                                                   limit=self._limit,
+                                                   offset=self._offset,
+                                                   order_by=self._order_by)
+            statement = "SELECT %s FROM (%s)" % (expression, inner)
+        else:
+            statement, parameters = model._build_query("SELECT", self._where,
+                                                       limit=self._limit,
+                                                       offset=self._offset,
+                                                       order_by=self._order_by,
+                                                       select=tuple(group_by) + (expression,),
+                                                       group_by=group_by)
+
+        cursor = model._execute("SELECT", statement, parameters)
+        try:
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        #Only convert the values that need it, and never NULLs, which is
+        #what aggregates over no rows at all give.
+        converters = [model._field_by_column[x].from_db_format for x in group_by]
+        converters.append(convert)
+        converters = [(i, x) for i, x in enumerate(converters)
+                      if x is not None and getattr(x, "__func__", None) is not _no_conversion]
+
+        if converters:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i, convert in converters:
+                    if row[i] is not None:
+                        row[i] = convert(row[i])
+
+        if not group_by:
+            return rows[0][0]
+        return [tuple(row) for row in rows]
+
+    def explain(self):
+        """Get the query plan SQLite uses for the query, as given by
+        EXPLAIN QUERY PLAN.
+
+        Returns:
+            A list of strings describing each step of the query plan, for
+            example "SEARCH car USING INDEX idx_car_make (make=?)".
+
+        """
+        statement, parameters = self.model._build_query("SELECT", self._where,
+                                                        limit=self._limit,
+                                                        offset=self._offset,
+                                                        order_by=self._order_by)
+        cursor = SQLite().cursor()
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            return [row[-1] for row in cursor]
+        finally:
+            cursor.close()
+
+    def aiter(self, chunk_size=None):
+        """Get an AsyncQuery for iterating the query set from asyncio code.
+
+        Parameters:
+            chunk_size: Number of rows to fetch at a time. Defaults to the
+                chunk_size of the query set.
+
+        """
+        return AsyncQuery(self, chunk_size)
+
+    def iterator(self, chunk_size=None):
+        """Generator that runs the query and yields the model instances, or
+        values if values or values_list was used, fetching chunk_size rows
+        from the database at a time.
+
+        Parameters:
+            chunk_size: Number of rows to fetch at a time. Defaults to the
+                chunk_size of the query set.
+
+        """
+        chunk_size = chunk_size or self.chunk_size
+        select, make = self._row_factory()
+        related = self._projection is None
+        if related and self._select_related:
+            statement, parameters, make = self._select_related_query()
+            cursor = self.model._execute("SELECT", statement, parameters)
+        else:
+            cursor = self.model._generate_query("SELECT", where=self._where,
+                                                limit=self._limit,
+                                                offset=self._offset,
+                                                order_by=self._order_by,
+                                                select=select)
+        prefetch = related and self._prefetch_related
+        timed = cursor.__class__ is InstrumentedCursor
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                if make is None:
+                    for row in rows:
+                        yield row
+                elif timed or prefetch:
+                    #Make the whole chunk at once so the time it takes can
+                    #be told apart from the time spent in sqlite, and the
+                    #related instances of the chunk fetched together.
+                    start = time.time()
+                    rows = [make(row) for row in rows]
+                    if timed:
+                        cursor.hydration += time.time() - start
+                    if prefetch:
+                        self._prefetch(rows)
+                    for row in rows:
+                        yield row
+                else:
+                    for row in rows:
+                        yield make(row)
+        finally:
+            cursor.close()
+
+    def __iter__(self):
+        """Iterate over the results, streaming them from the database unless
+        they have already been loaded.
+
+        This is a generator so the cache is only checked once iterating
+        starts. list() gets the iterator before it calls __len__, which
+        loads the results, and would otherwise run the query twice.
+
+        """
+        results = self._result_cache
+        if results is None:
+            results = self.iterator()
+        for x in results:
+            yield x
+
+    def __len__(self):
+        """Load all the results and return the number of them. The results
+        are kept so iterating afterwards does not run the query again. Use
+        count to only count the results without loading them.
+
+        """
+        if self._result_cache is None:
+            self._result_cache = list(self.iterator())
+        return len(self._result_cache)
+
+    def __nonzero__(self):
+        """Check whether the query has any results by fetching at most
+        a single row.
+
+        """
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return self.exists()
+
+    __bool__ = __nonzero__
+
+    def __getitem__(self, key):
+        """Get a single instance by index or a new query set limited to
+        the slice. Negative indexes and steps are not supported.
+
+        """
+        if self._result_cache is not None:
+            return self._result_cache[key]
+
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError("Slicing a query with a step is not supported.")
+            start = key.start or 0
+            stop = key.stop
+        else:
+            start = key
+            stop = key + 1
+
+        if start < 0 or (stop is not None and stop < 0):
+            raise ValueError("Negative indexing of a query is not supported.")
+
+        #Work out the new limit relative to the current slice so slicing
+        #an already sliced query set works like slicing a list twice.
+        limit = None if stop is None else max(stop - start, 0)
+        if self._limit is not None:
+            remaining = max(self._limit - start, 0)
+            limit = remaining if limit is None else min(limit, remaining)
+
+        clone = self._clone()
+        clone._offset = self._offset + start
+        clone._limit = limit
+
+        if isinstance(key, slice):
+            return clone
+        for x in clone:
+            return x
+        raise IndexError("Query index out of range.")
+
+class AsyncCall(object):
+    """A call to run on the DatabaseThread once it is awaited. Returned by
+    the aget and asave methods of models.
+
+    Nothing is sent to the thread until the call is awaited, and awaiting
+    it also waits for a free place on the thread, see DatabaseThread.
+
+    """
+
+    def __init__(self, func, write=False):
+        """Initialize the AsyncCall with the function to run."""
+        self.func = func
+        self.write = write
+
+    def __await__(self):
+        """Run the function and get its result."""
+        return DatabaseThread.instance().submit(self.func, self.write).__await__()
+
+class AsyncQuery(object):
+    """Runs a query set on the DatabaseThread for asyncio code. Returned by
+    the afilter method of models and aiter of query sets.
+
+    It can either be iterated with async for, which fetches chunk_size
+    instances from the thread at a time, or awaited to get every instance
+    in a list.
+
+    Example:
+        async for x in car.afilter(wheels__gte=4):
+            print(x)
+        cars = await car.filter(make="Opel").order_by("made").aiter()
+
+    """
+
+    def __init__(self, queryset, chunk_size=None):
+        """Initialize the AsyncQuery with the query set to run."""
+        self.queryset = queryset
+        self.chunk_size = chunk_size or queryset.chunk_size
+        self._iterator = None
+        self._chunk = collections.deque()
+
+    def __await__(self):
+        """Run the query and get every instance in a list."""
+        func = functools.partial(list, self.queryset)
+        return DatabaseThread.instance().submit(func).__await__()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        """Get the next instance, fetching the next chunk from the database
+        thread once the current one runs out.
+
+        """
+        import asyncio
+
+        if not self._chunk:
+            return DatabaseThread.instance().submit(self._fetch)
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(self._chunk.popleft())
+        return future
+
+    def _fetch(self):
+        """Private method that runs on the database thread and fetches the
+        next chunk of instances, returning the first one.
 
         """
-        return functools.partial(self.func, instance if instance else owner)
+        if self._iterator is None:
+            self._iterator = self.queryset.iterator(self.chunk_size)
+        chunk = list(itertools.islice(self._iterator, self.chunk_size))
+        if not chunk:
+            raise StopAsyncIteration()
+        self._chunk.extend(chunk[1:])
+        return chunk[0]
+
+#The running totals of Model.import_, given to its progress callback and
+#returned once the import is done.
+ImportProgress = collections.namedtuple("ImportProgress", "read imported errors")
+
+#The csv module of python 2 only reads and writes bytes, so text goes
+#through it as utf-8 there.
+if str is bytes:
+    _csv_encode = lambda row: [x.encode("utf-8") if isinstance(x, unicode) else x for x in row]
+    _csv_decode = lambda row: [x.decode("utf-8") for x in row]
+else:
+    _csv_encode = _csv_decode = None
+
+def _with_metaclass(meta, *bases):
+    """Create a base class for a class that should have meta as its
+    metaclass. Python 2 and 3 declare metaclasses differently, this works
+    with both by creating the class with meta directly.
 
-class Model(object):
+    """
+    class metaclass(type):
+        def __new__(cls, name, this_bases, dct):
+            return meta(name, bases, dct)
+    return type.__new__(metaclass, "temporary_class", (), {})
+
+class Model(_with_metaclass(ModelMeta, object)):
     """A base model class to be inherited and used to map objects to tables.
 
     Contains static functions for retrieving and filtering objects as well
     as other common ORM functionality.
 
+    Models that set __compact__ to True get compact instances, which have
+    no __dict__ and keep the value of each field in a slot of its own. For
+    a model of four short columns they take about 30% less memory than
+    normal instances, at the cost of about 20% slower loading and of not
+    being able to have any attributes other than their fields. The values
+    themselves are the same either way, so the more of the memory they take
+    the smaller the saving:
+
+        class reading(Model):
+            __compact__ = True
+            sensor = FieldInteger()
+            value = FieldDecimal()
+
     """
 
-    __metaclass__ = ModelMeta
+    #Model is only a base class and has no table.
+    __abstract__ = True
+
+    #Instances of models that aren't compact still get a __dict__ as
+    #usual, but this makes it possible for compact ones not to have one.
+    __slots__ = ()
+
     _saved = False
+
+    #Attributes of fields changed since the instance was loaded or last
+    #saved. Field.__set__ gives each instance its own set.
+    _dirty = _clean
     
     def __init__(self, *args, **kwargs):
         """Initialize the model class."""
 
-        #Go over all the attributes and initalize the descriptors
+        if self._compact:
+            self._lazy = 0
+            self._saved = False
+            self._dirty = _clean
+
+        #Go over all the fields and initalize the descriptors
         #with the default values.
-        for attr, value in self.__class__.__dict__.items():
-            if isinstance(value, Field):
-                if attr in kwargs:
-                    setattr(self, attr, kwargs[attr])
-                else:
-                    setattr(self, attr, value.default)
+        for field in self._fields:
+            if field.attr in kwargs:
+                setattr(self, field.attr, kwargs[field.attr])
+            else:
+                setattr(self, field.attr, field.default)
 
     def save(self):
         """Save all the data in current instance to database. If the
         instance is new, it is inserted and the primary key saved.
         Otherwise it updates the record in database.
 
+        An update only writes the fields that have changed since the instance
+        was loaded or last saved, along with any auto_now fields. If no field
+        has changed, nothing is sent to the database.
+
         """
 
-        #A holder that will contain all the data to be saved.
-        data = {}
+        fields = [field for field in self._fields if field.is_key == False]
 
-        #Loop over every attribute in the class, check if it's a field and
-        #if so, save it to the dict. We call the to_db_format in the field
-        #to make sure the data is in format compatible with sqlite.
-        for attr, value in self.__class__.__dict__.items():
-            if isinstance(value, Field) and value.is_key == False:
-                data[value.column_name] = value.to_db_format(getattr(self, attr),
-                                                             not self._saved,
-                                                             True)
+        if self._saved:
+            #Only write the changed fields. auto_now fields don't count as a
+            #change on their own but are updated whenever the row is.
+            fields = [field for field in fields if field.attr in self._dirty]
+            if not fields:
+                return
+            fields += [field for field in self._fields
+                       if getattr(field, "auto_now", False) and field not in fields]
+
+        #A holder that will contain all the data to be saved. We call the
+        #to_db_format in the field to make sure the data is in format
+        #compatible with sqlite.
+        data = {}
+        for field in fields:
+            data[field.column_name] = field.get_db_value(self, not self._saved, True)
 
         if self._saved:
             #We are updating a previous record in the database so we call
@@ -506,32 +2760,406 @@ class Model(object):
             cursor = self._generate_query("INSERT", {}, data=data)
             setattr(self, self._primary_key, cursor.lastrowid)
 
-        #Make sure the changes are commited before the close the cursor.
-        SQLite().commit()
+        #The statement is commited straight away unless we are inside a
+        #transaction block, in which case it is commited with the block.
+        cursor.close()
+        self._saved = True
+        self._dirty = _clean
+
+        if self._cache is not None:
+            self._cache.discard(getattr(self, self._primary_key))
+
+    @classmethod
+    def bulk_save(cls, instances, batch_size=500):
+        """Save many instances of the current model inside a single
+        transaction. New instances are inserted and existing ones updated,
+        batch_size rows at a time, using executemany so the statement is
+        only built once and the database only commits once.
+
+        Existing instances without any changed fields are skipped, the
+        others have all their fields written. New instances get their
+        primary key and are marked as saved once the transaction has been
+        commited. If anything fails, the whole
+        transaction is rolled back and no instance is changed. Inside a
+        transaction block, the batches become part of that transaction.
+
+        Parameters:
+            instances: An iterable of instances of the current model.
+            batch_size: Number of rows to send with each executemany call.
+
+        """
+
+        #Same fields save() writes to database but in a fixed order so every
+        #row in a batch lines up with the columns in the statement.
+        fields = [field for field in cls._fields if field.is_key == False]
+
+        columns = tuple(field.column_name for field in fields)
+
+        insert = cls._compile_query("INSERT", ("AND", False, ()), columns)[0]
+        update = cls._compile_query("UPDATE", ("AND", False, (cls._primary_key,)),
+                                    columns)[0]
+
+        #Holds (instance, primary key) for every written instance so we can
+        #update them after the transaction has been commited. The key is
+        #None for instances that were updated.
+        written = []
+
+        with transaction():
+            cursor = SQLite().cursor()
+            try:
+                batch = []
+                for instance in instances:
+                    batch.append(instance)
+                    if len(batch) >= batch_size:
+                        written.extend(cls._save_batch(cursor, batch, fields,
+                                                       insert, update))
+                        batch = []
+                if batch:
+                    written.extend(cls._save_batch(cursor, batch, fields,
+                                                   insert, update))
+            finally:
+                cursor.close()
+
+        for instance, key in written:
+            if key is not None:
+                setattr(instance, cls._primary_key, key)
+            elif cls._cache is not None:
+                cls._cache.discard(getattr(instance, cls._primary_key))
+            instance._saved = True
+            instance._dirty = _clean
+
+    @classmethod
+    def _save_batch(cls, cursor, batch, fields, insert, update):
+        """A hidden method that writes a single batch for bulk_save. Updates
+        are sent with one executemany and inserts with another.
+
+        Returns:
+            List of tuples with each written instance and its new primary
+            key, or None as the key for updated instances.
+
+        """
+        new = [x for x in batch if not x._saved]
+        old = [x for x in batch if x._saved and x._dirty]
+
+        if old:
+            start = time.time()
+            cursor.executemany(update, [
+                [f.get_db_value(x, False, True) for f in fields] +
+                [getattr(x, cls._primary_key)] for x in old])
+            if Instrumentation.enabled:
+                Instrumentation.record(cls, "UPDATE", update, None,
+                                       time.time() - start, cursor.rowcount)
+
+        if not new:
+            return [(x, None) for x in old]
+
+        start = time.time()
+        cursor.executemany(insert, [
+            [f.get_db_value(x, True, True) for f in fields]
+            for x in new])
+        if Instrumentation.enabled:
+            Instrumentation.record(cls, "INSERT", insert, None,
+                                   time.time() - start, cursor.rowcount)
+
+        #executemany doesn't report the rowid of each row. SQLite hands out
+        #rowids in sequence while we hold the write lock so we count back
+        #from the last one to get the key of each new instance.
+        cursor.execute("SELECT last_insert_rowid()")
+        last = cursor.fetchone()[0]
+        first = last - len(new) + 1
+        return [(x, None) for x in old] + [(x, first + i) for i, x in enumerate(new)]
+
+    def upsert(self, conflict_on=None, update_fields=None):
+        """Insert the instance, or update the row it conflicts with, with a
+        single INSERT ... ON CONFLICT DO UPDATE statement. Whether the
+        instance was loaded or saved before doesn't matter, afterwards it
+        has the primary key of the row and is marked as saved.
+
+        The primary key the instance has is written, so upserting on it
+        updates the row with that key. Only an INTEGER primary key that is
+        still None or its default is left for sqlite to pick, which makes
+        the statement a plain insert. Other primary keys have to be set.
+
+        Parameters:
+            conflict_on: Names of the columns of a primary key or unique
+                constraint that decide which row the instance is. Defaults
+                to the primary key, which models without a primary key field
+                don't have.
+            update_fields: Names of the columns written when the row already
+                exists. Defaults to every column except the conflict_on ones
+                and auto_now_add fields. Empty to leave existing rows as
+                they are.
+
+        """
+        #Since sqlite 3.35 the statement can return the primary key of the
+        #row, whether it was inserted or updated.
+        returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+        fields, conflict_on, statement = self._compile_upsert(conflict_on, update_fields,
+                                                              returning)
+        new = self._primary_key in conflict_on and self._new_key()
+        cursor = self._execute("INSERT", statement, self._upsert_values(fields))
+        row = cursor.fetchone() if returning else None
+        if row is None and new:
+            row = (cursor.lastrowid,)
         cursor.close()
+
+        #Rows that were left alone aren't returned either, so look the key
+        #up by the conflicting columns.
+        if row is None:
+            where = dict((column, getattr(self, self._field_by_column[column].attr))
+                         for column in conflict_on)
+            cursor = self._generate_query("SELECT", where=where, limit=1,
+                                          select=(self._primary_key,))
+            row = cursor.fetchone()
+            cursor.close()
+
+        setattr(self, self._primary_key, row[0])
         self._saved = True
+        self._dirty = _clean
+
+        if self._cache is not None:
+            self._cache.discard(row[0])
+
+    @classmethod
+    def bulk_upsert(cls, instances, conflict_on=None, update_fields=None, batch_size=500):
+        """Upsert many instances of the current model inside a single
+        transaction, batch_size rows at a time with executemany. See upsert
+        for the parameters.
+
+        Unless the primary key is one of the conflict_on columns, the keys
+        of the rows are looked up with a single SELECT per batch. Instances
+        that aren't saved are inserted with a new primary key. Like with
+        bulk_save, the instances are only changed once the transaction has
+        been commited.
+
+        Parameters:
+            instances: An iterable of instances of the current model.
+            conflict_on: Names of the columns that decide which row an
+                instance is.
+            update_fields: Names of the columns written when a row already
+                exists.
+            batch_size: Number of rows to send with each executemany call.
+
+        """
+        fields, conflict_on, statement = cls._compile_upsert(conflict_on, update_fields,
+                                                             False)
+        written = []
+
+        with transaction():
+            cursor = SQLite().cursor()
+            try:
+                batch = []
+                for instance in instances:
+                    batch.append(instance)
+                    if len(batch) >= batch_size:
+                        written.extend(cls._upsert_batch(cursor, batch, fields,
+                                                         conflict_on, statement))
+                        batch = []
+                if batch:
+                    written.extend(cls._upsert_batch(cursor, batch, fields,
+                                                     conflict_on, statement))
+            finally:
+                cursor.close()
+
+        for instance, key in written:
+            setattr(instance, cls._primary_key, key)
+            instance._saved = True
+            instance._dirty = _clean
+            if cls._cache is not None:
+                cls._cache.discard(key)
+
+    @classmethod
+    def _upsert_batch(cls, cursor, batch, fields, conflict_on, statement):
+        """A hidden method that writes a single batch for bulk_upsert.
+
+        Returns:
+            List of tuples with each written instance and its primary key.
+
+        """
+        rows = [x._upsert_values(fields) for x in batch]
+
+        if cls._primary_key in conflict_on:
+            #Instances without a key are plain inserts. Like in _save_batch,
+            #their keys are counted back from the last rowid, so they are
+            #sent apart from the instances with a key.
+            unset = [x._new_key() for x in batch]
+            old = [x for x, empty in zip(batch, unset) if not empty]
+            new = [x for x, empty in zip(batch, unset) if empty]
+            if old:
+                cls._upsert_rows(cursor, statement,
+                                 [row for row, empty in zip(rows, unset) if not empty])
+            if not new:
+                return [(x, getattr(x, cls._primary_key)) for x in old]
+            cls._upsert_rows(cursor, statement,
+                             [row for row, empty in zip(rows, unset) if empty])
+            cursor.execute("SELECT last_insert_rowid()")
+            first = cursor.fetchone()[0] - len(new) + 1
+            return ([(x, getattr(x, cls._primary_key)) for x in old] +
+                    [(x, first + i) for i, x in enumerate(new)])
+
+        cls._upsert_rows(cursor, statement, rows)
+
+        #Look the keys up by the values of the conflicting columns, as many
+        #rows at a time as fit in the 999 parameters older sqlite allows.
+        columns = [f.column_name for f in fields]
+        positions = [columns.index(column) for column in conflict_on]
+        values = [tuple(row[i] for i in positions) for row in rows]
+        keys = {}
+        step = max(1, 999 // len(conflict_on))
+        for i in range(0, len(values), step):
+            chunk = values[i:i + step]
+            row_query = "(%s)" % ', '.join("?" * len(conflict_on))
+            select = cls._execute("SELECT", "SELECT %s, %s FROM %s WHERE (%s) IN (VALUES %s)" % (
+                cls._primary_key, ', '.join(conflict_on), cls._tablename,
+                ', '.join(conflict_on), ', '.join([row_query] * len(chunk))),
+                [value for row in chunk for value in row])
+            try:
+                for row in select.fetchall():
+                    keys[tuple(row[1:])] = row[0]
+            finally:
+                select.close()
+        return [(x, keys.get(value)) for x, value in zip(batch, values)]
+
+    @classmethod
+    def _upsert_rows(cls, cursor, statement, rows):
+        """A hidden method that sends rows of bulk_upsert with executemany."""
+        start = time.time()
+        cursor.executemany(statement, rows)
+        if Instrumentation.enabled:
+            Instrumentation.record(cls, "INSERT", statement, None,
+                                   time.time() - start, cursor.rowcount)
+
+    def _upsert_values(self, fields):
+        """A hidden method that gets the values of the instance for the
+        upsert statement. The primary key is NULL when sqlite should pick
+        one, see _new_key.
+
+        """
+        return [None if field.is_key and self._new_key()
+                else field.get_db_value(self, True, True) for field in fields]
+
+    def _new_key(self):
+        """A hidden method that tells whether sqlite should pick the primary
+        key of the instance, which is when an INTEGER primary key is still
+        None or its default. Other primary keys are never left to sqlite,
+        which would store NULL.
+
+        """
+        field = self._field_by_column[self._primary_key]
+        value = field.__get__(self, None)
+        if field.column_type == "INTEGER":
+            return value is None or value == field.default
+        if value is None:
+            raise TypeError("The primary key %s of %s has to be set to upsert on it." %
+                            (self._primary_key, self.__class__.__name__))
+        return False
+
+    @classmethod
+    def _compile_upsert(cls, conflict_on, update_fields, returning):
+        """A hidden method that builds the INSERT ... ON CONFLICT statement
+        of upsert and bulk_upsert. Statements are kept in _statements.
+
+        Parameters:
+            conflict_on: Names of the conflicting columns or None.
+            update_fields: Names of the columns to update or None.
+            returning: Boolean specifying whether the statement returns the
+                primary key.
+
+        Returns:
+            A tuple with the fields whose values the statement takes, in
+            order, the names of the conflicting columns and the statement.
+
+        """
+        if conflict_on is None:
+            if cls._primary_key == "_rowid_":
+                raise TypeError("Model %s has no primary key field. Specify the columns "
+                                "to upsert on with conflict_on." % cls.__name__)
+            conflict_on = (cls._primary_key,)
+        conflict_on = tuple(conflict_on)
+        if update_fields is not None:
+            update_fields = tuple(update_fields)
+
+        key = ("UPSERT", conflict_on, update_fields, returning)
+        if key in cls._statements:
+            return cls._statements[key]
+
+        for column in conflict_on + (update_fields or ()):
+            cls._check_column(column)
+
+        #The primary key is only written when it's what the rows conflict
+        #on, otherwise it's left for sqlite to pick like on save.
+        fields = [field for field in cls._fields
+                  if field.is_key == False or field.column_name in conflict_on]
+        if update_fields is None:
+            update_fields = [field.column_name for field in fields
+                             if field.column_name not in conflict_on
+                             and not getattr(field, "auto_now_add", False)]
+
+        statement = cls._compile_query("INSERT", ("AND", False, ()),
+                                       [field.column_name for field in fields])[0]
+        statement += " ON CONFLICT (%s)" % ', '.join(conflict_on)
+        if update_fields:
+            statement += " DO UPDATE SET %s" % ', '.join(
+                ["%s = excluded.%s" % (x, x) for x in update_fields])
+        else:
+            statement += " DO NOTHING"
+        if returning:
+            statement += " RETURNING %s" % cls._primary_key
+
+        cls._statements[key] = (fields, conflict_on, statement)
+        return cls._statements[key]
 
     @class_or_instance
-    def delete(self, **kwargs):
+    def delete(self, *args, **kwargs):
         """Delete current instance from database when called through an instance.
         Otherwise deletes any entries that match the lookup parameters when
         called through the class.
 
+        Like save, the delete is commited straight away unless it runs
+        inside a transaction block.
+
         Parameters:
-            Lookup field parameters for the delete statement.
+            Q objects and lookup field parameters for the delete statement.
+
+        Returns:
+            The number of deleted rows.
 
         """
         if isinstance(self, type):
             #When self is None, this function is being called from the
             #class and as such, we run the delete query with the lookup
             #parameters.
-            cursor = self._generate_query("DELETE", where=kwargs)
+            return QuerySet(self).filter(*args, **kwargs).delete()
         elif self._saved:
             #The delete function was called from an instance, delete
             #it using the primary key lookup field.
             cursor = self._generate_query("DELETE", where={
                     self._primary_key: getattr(self, self._primary_key)
                  })
+            if self._cache is not None:
+                self._cache.discard(getattr(self, self._primary_key))
+        else:
+            return 0
+        count = cursor.rowcount
+        cursor.close()
+        return count
+
+    @classmethod
+    def update(cls, values, *args, **kwargs):
+        """Update every row that matches the lookup parameters with a single
+        UPDATE, without loading any of them. See QuerySet.update.
+
+        Parameters:
+            values: Dict of the names of the columns and their new values.
+            *args: Q objects the rows have to match.
+            **kwargs: Named fields and values of the rows to update. The
+                names can end with a lookup such as "__gt", see Q.
+
+        Returns:
+            The number of updated rows.
+
+        """
+        return QuerySet(cls).filter(*args, **kwargs).update(**values)
 
     @classmethod
     def get(cls, id=None, **kwargs):
@@ -552,35 +3180,455 @@ class Model(object):
             #primary key of the object without naming the field specificly.
             kwargs = {cls._primary_key: id}
 
+        #Lookups on the primary key alone can be answered from the cache
+        #if the model has one. The cache is shared by every thread, so it
+        #isn't used inside a transaction, where rows can hold changes that
+        #aren't commited yet.
+        cache = None
+        if (cls._cache is not None and len(kwargs) == 1 and cls._primary_key in kwargs
+                and not getattr(SQLite._local, "depth", 0)):
+            cache = cls._cache
+            result = cache.get(kwargs[cls._primary_key])
+            if result is not None:
+                return result
+
         #Query the database with the selected fields and get the first
         #instance. If many are found, only the first one is returned.
-        cursor = cls._generate_query("SELECT", where=kwargs)
-        result = cls._result_to_model(cursor.fetchone())
+        cursor = cls._generate_query("SELECT", where=kwargs, limit=1)
+        if cursor.__class__ is InstrumentedCursor:
+            row = cursor.fetchone()
+            start = time.time()
+            result = cls._result_to_model(row)
+            cursor.hydration += time.time() - start
+        else:
+            result = cls._result_to_model(cursor.fetchone())
 
         cursor.close()
+
+        if cache is not None and result is not None:
+            cache.put(kwargs[cls._primary_key], result)
         return result
 
     @classmethod
-    def filter(cls, **kwargs):
+    def cache_info(cls):
+        """Get the hits, misses, maximum size and current size of the
+        model's instance cache as a CacheInfo named tuple, or None if the
+        model has no cache.
+
+        """
+        if cls._cache is None:
+            return None
+        return cls._cache.info()
+
+    @classmethod
+    def cache_clear(cls):
+        """Remove every instance from the model's instance cache."""
+        if cls._cache is not None:
+            cls._cache.clear()
+
+    @classmethod
+    def filter(cls, *args, **kwargs):
         """Get all objects from the database that match the named parameters
         values.
 
         Parameters:
-            **kwargs: Named fields and values of objects to search for.
+            *args: Q objects the objects have to match.
+            **kwargs: Named fields and values of objects to search for. The
+                names can end with a lookup such as "__gt", see Q.
 
         Returns:
-            Array of model instances of all the results found.
+            A lazy QuerySet of the matching model instances. The query is
+            only run when the query set is iterated.
 
         """
-        result = []
-        cursor = cls._generate_query("SELECT", where=kwargs)
-        for row in cursor:
-            result.append(cls._result_to_model(row))
-        cursor.close()
-        return result
+        return QuerySet(cls).filter(*args, **kwargs)
+
+    @classmethod
+    def iter_chunks(cls, chunk_size=1000, order_by=None):
+        """Walk every row of the table in lists of chunk_size instances using
+        keyset paging. See QuerySet.iter_chunks.
+
+        """
+        return QuerySet(cls).iter_chunks(chunk_size, order_by)
+
+    @classmethod
+    def paginate(cls, after=None, limit=100, order_by=None):
+        """Get a page of the rows of the table using keyset paging. See
+        QuerySet.paginate.
+
+        """
+        return QuerySet(cls).paginate(after, limit, order_by)
+
+    @classmethod
+    def parallel_map(cls, func, where=None, workers=None, ordered=True, chunks_per_worker=4):
+        """Call func with every matching instance in a pool of worker
+        processes and yield the results, so loading and processing large
+        tables uses every core.
+
+        The primary key range of the matching rows is split into ranges
+        that the workers load and process on their own, each with a read
+        only connection of its own. The primary key has to be an integer,
+        which _rowid_ of models without one always is.
+
+        func and the model are sent to the workers by pickle, so they have
+        to be defined at the top level of a module. The database can't be
+        :memory:.
+
+        Example:
+            for total in orders.parallel_map(order_total, {"year": 2013}):
+                print(total)
+
+        Parameters:
+            func: Function called with each instance in the workers.
+            where: Dict of the named fields and values to match, see
+                filter, or a Q object.
+            workers: Number of worker processes. Defaults to the number of
+                cores.
+            ordered: Boolean specifying whether the results are yielded in
+                primary key order. Otherwise they are yielded as soon as the
+                range they belong to is done.
+            chunks_per_worker: Number of ranges to split the work into per
+                worker, so workers that finish early can take on more.
+
+        """
+        if settings.SQLITE_FILE == ":memory:":
+            raise ValueError("parallel_map needs a database file, not :memory:.")
+
+        queryset = QuerySet(cls, where)
+        key = cls._primary_key
+        low, high = queryset.min(key), queryset.max(key)
+        if low is None:
+            return
+        try:
+            low, high = operator.index(low), operator.index(high)
+        except TypeError:
+            raise TypeError("parallel_map needs an integer primary key.")
+
+        workers = workers or multiprocessing.cpu_count()
+        count = min(workers * chunks_per_worker, high - low + 1)
+        step = -(-(high - low + 1) // count)
+        ranges = [(cls, queryset._where, func, start, min(start + step, high + 1), ordered)
+                  for start in range(low, high + 1, step)]
+
+        pool = multiprocessing.Pool(workers, _parallel_init, (settings.SQLITE_FILE,))
+        try:
+            results = pool.imap if ordered else pool.imap_unordered
+            for chunk in results(_parallel_range, ranges):
+                for result in chunk:
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @classmethod
+    def export(cls, fileobj, format="csv", where=None, columns=None):
+        """Write the matching rows to a file as CSV or JSON Lines. The rows
+        are streamed from the database, so memory use doesn't grow with the
+        number of rows.
+
+        Values are written the way they are stored in the database, as
+        to_db_format gives them, so import_ can read them back. CSV starts
+        with a header of the column names and writes NULL as an empty cell.
+        JSON Lines writes an object for each row.
+
+        Example:
+            with open("cars.csv", "w", newline="") as f:
+                car.export(f, where={"make": "Volvo"})
+
+        Parameters:
+            fileobj: File to write to. For CSV, open it with newline="" on
+                python 3 and in binary mode on python 2.
+            format: Either "csv" or "jsonl".
+            where: Dict of the named fields and values to match, see
+                filter, or a Q object.
+            columns: Names of the columns to write. Defaults to all.
+
+        Returns:
+            The number of rows written.
+
+        """
+        if format not in ("csv", "jsonl"):
+            raise ValueError("Unknown format %s. Use one of csv, jsonl." % format)
+
+        columns = tuple(columns or cls._columns)
+        rows = QuerySet(cls, where).values_list(*columns, convert=False).iterator()
+
+        count = 0
+        if format == "csv":
+            writer = csv.writer(fileobj)
+            writer.writerow(columns)
+            for count, row in enumerate(rows, 1):
+                writer.writerow(_csv_encode(row) if _csv_encode else row)
+        else:
+            write, dumps = fileobj.write, json.dumps
+            for count, row in enumerate(rows, 1):
+                write(dumps(dict(zip(columns, row))) + "\n")
+        return count
+
+    @classmethod
+    def import_(cls, fileobj, format="csv", batch_size=500, commit_every=100000,
+                on_error=None, progress=None):
+        """Insert the rows of a CSV or JSON Lines file, like the ones export
+        writes. The file is read a row at a time and the rows are inserted
+        batch_size at a time with executemany.
+
+        Every value goes through the from_db_format, validate and
+        to_db_format of its field, so bad values are caught before they
+        reach the table. Empty CSV cells are NULL, except in TEXT columns.
+        Rows with a primary key are inserted with it, the others get a new
+        one. auto_now fields keep the imported value. Columns missing from
+        the file get the value a new instance would be saved with. For
+        auto_now and auto_now_add fields that is the time each row is read.
+
+        The rows are commited every commit_every rows, so long imports don't
+        build up one huge transaction. Inside a transaction block, they are
+        commited with the block instead.
+
+        A row that fails, whether it can't be read, fails in its field or in
+        the database, stops the import with its exception. Rows commited
+        before it stay in the table. If on_error is given, it is called with
+        the line number, the row and the exception instead and the import
+        goes on without the row. The row is the list of CSV values, None for
+        CSV lines that can't be read, or the line of text for JSON Lines.
+
+        Example:
+            with open("cars.csv", newline="") as f:
+                car.import_(f, on_error=lambda line, row, e: log(line, e))
+
+        Parameters:
+            fileobj: File to read. CSV files must start with a header of the
+                column names. For CSV, open it with newline="" on python 3
+                and in binary mode on python 2.
+            format: Either "csv" or "jsonl".
+            batch_size: Number of rows to send with each executemany call.
+            commit_every: Number of rows to commit at a time, or None to
+                import everything in a single transaction.
+            on_error: Function called with the line number, the row and the
+                exception of every row that fails.
+            progress: Function called with an ImportProgress after every
+                batch.
+
+        Returns:
+            An ImportProgress with the number of rows read, imported and
+            failed.
+
+        """
+        if format not in ("csv", "jsonl"):
+            raise ValueError("Unknown format %s. Use one of csv, jsonl." % format)
+
+        #The rows are (line number, row, error) tuples. Errors reading the
+        #file are handed on with the row so they are reported like any other
+        #failing row instead of ending the import.
+        if format == "csv":
+            reader = csv.reader(fileobj)
+            columns = next(reader, [])
+            if _csv_decode:
+                columns = _csv_decode(columns)
+            rows = cls._import_csv_rows(reader)
+        else:
+            rows = ((line, text.rstrip("\r\n"), None)
+                    for line, text in enumerate(fileobj, 1) if text.strip())
+
+            #The columns are the keys of the first object. Lines before it
+            #that can't be read are imported, and fail, like the others.
+            columns, read_ahead = [], []
+            for item in rows:
+                read_ahead.append(item)
+                try:
+                    first = json.loads(item[1])
+                except ValueError:
+                    continue
+                if isinstance(first, dict):
+                    columns = list(first)
+                    break
+            rows = itertools.chain(read_ahead, rows)
+
+        converters = [cls._import_converter(column, format == "csv") for column in columns]
+        width = len(columns)
+
+        #Columns missing from the file get what save would write for a new
+        #instance, so NOT NULL columns and auto_now fields are filled in.
+        #The time of auto_now and auto_now_add fields is taken for every row,
+        #the other defaults only once.
+        missing = [field for field in cls._fields
+                   if not field.is_key and field.column_name not in columns]
+        timed = [field for field in missing
+                 if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False)]
+        missing = [field for field in missing if field not in timed] + timed
+        blank = cls() if missing else None
+        defaults = [field.get_db_value(blank, True, True) for field in missing
+                    if field not in timed]
+        statement = cls._compile_query("INSERT", ("AND", False, ()), tuple(
+            columns + [field.column_name for field in missing]))[0]
+
+        def convert(row):
+            if format == "jsonl":
+                row = json.loads(row)
+                if not isinstance(row, dict):
+                    raise TypeError("Expected a JSON object but found %s." % type(row).__name__)
+                row = [row[column] for column in columns]
+            elif len(row) != width:
+                raise ValueError("Expected %d values but found %d." % (width, len(row)))
+            values = [converter(value) for converter, value in zip(converters, row)] + defaults
+            if timed:
+                values.extend([field.get_db_value(blank, True, True) for field in timed])
+            return values
+
+        read = imported = errors = 0
+        while True:
+            start = read
+            with transaction():
+                cursor = SQLite().cursor()
+                try:
+                    batch = []
+                    for line, row, error in itertools.islice(rows, commit_every):
+                        read += 1
+                        try:
+                            if error is not None:
+                                raise error
+                            batch.append((line, row, convert(row)))
+                        except Exception as e:
+                            if on_error is None:
+                                raise
+                            on_error(line, row, e)
+                            errors += 1
+                        if len(batch) >= batch_size:
+                            written = cls._import_batch(cursor, statement, batch, on_error)
+                            imported += written
+                            errors += len(batch) - written
+                            batch = []
+                            if progress is not None:
+                                progress(ImportProgress(read, imported, errors))
+                    if batch:
+                        written = cls._import_batch(cursor, statement, batch, on_error)
+                        imported += written
+                        errors += len(batch) - written
+                        if progress is not None:
+                            progress(ImportProgress(read, imported, errors))
+                finally:
+                    cursor.close()
+            if commit_every is None or read - start < commit_every:
+                break
+        return ImportProgress(read, imported, errors)
+
+    @staticmethod
+    def _import_csv_rows(reader):
+        """A hidden generator that reads the rows of a csv reader for
+        import_, yielding lines that can't be read along with their error.
+
+        """
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield reader.line_num, None, e
+                continue
+            yield reader.line_num, _csv_decode(row) if _csv_decode else row, None
+
+    @classmethod
+    def _import_converter(cls, column, text):
+        """A hidden method that gets the function import_ converts the
+        values of a column with.
+
+        Parameters:
+            column: Name of the column.
+            text: Boolean specifying whether the values are read as text
+                from a CSV file.
+
+        """
+        field = cls._check_column(column)
+        from_db_format = field.from_db_format
+        to_db_format = field.to_db_format
+        validate = convert = field.validate
+
+        #Only the steps the field needs are chained, as this runs for every
+        #value. CSV values are text, which from_db_format of INTEGER columns
+        #doesn't expect. Others are left to validate and the column affinity.
+        if getattr(from_db_format, "__func__", None) is not _no_conversion:
+            if text and field.column_type == "INTEGER":
+                convert = lambda value: validate(from_db_format(int(value)))
+            else:
+                convert = lambda value: validate(from_db_format(value))
+        if getattr(to_db_format, "__func__", None) is not _no_db_conversion:
+            decode = convert
+            convert = lambda value: to_db_format(decode(value), True, False)
+
+        empty = "" if text and field.column_type != "TEXT" else None
+        return lambda value: None if value is None or value == empty else convert(value)
+
+    @classmethod
+    def _import_batch(cls, cursor, statement, batch, on_error):
+        """A hidden method that inserts a single batch for import_.
+
+        If the batch fails and on_error is given, the batch is rolled back
+        and the rows inserted one at a time instead, so the failing ones can
+        be reported and the others still inserted.
+
+        Returns:
+            The number of rows inserted.
+
+        """
+        if on_error is not None:
+            cursor.execute("SAVEPOINT litesimple_import")
+        try:
+            start = time.time()
+            cursor.executemany(statement, [values for line, row, values in batch])
+            if Instrumentation.enabled:
+                Instrumentation.record(cls, "INSERT", statement, None,
+                                       time.time() - start, cursor.rowcount)
+            written = len(batch)
+        except sqlite3.DatabaseError:
+            if on_error is None:
+                raise
+            cursor.execute("ROLLBACK TO litesimple_import")
+            written = 0
+            for line, row, values in batch:
+                try:
+                    cursor.execute(statement, values)
+                    written += 1
+                except sqlite3.DatabaseError as e:
+                    on_error(line, row, e)
+        if on_error is not None:
+            cursor.execute("RELEASE litesimple_import")
+        return written
+
+    @classmethod
+    def aget(cls, id=None, **kwargs):
+        """The asyncio counterpart of get. Runs get on the DatabaseThread.
+
+        Returns:
+            An AsyncCall to await for the model instance or None.
+
+        """
+        return AsyncCall(functools.partial(cls.get, id, **kwargs))
+
+    @classmethod
+    def afilter(cls, *args, **kwargs):
+        """The asyncio counterpart of filter. The matching instances are
+        fetched on the DatabaseThread.
+
+        Returns:
+            An AsyncQuery to iterate with async for or await.
+
+        """
+        return cls.filter(*args, **kwargs).aiter()
+
+    def asave(self):
+        """The asyncio counterpart of save. Runs save on the DatabaseThread,
+        where it can be batched together with other writes.
+
+        Returns:
+            An AsyncCall to await, which is done once the instance is saved.
+
+        """
+        return AsyncCall(self.save, write=True)
 
     @classmethod
-    def _generate_query(cls, query, where={}, data={}):
+    def _generate_query(cls, query, where={}, data={}, limit=None, offset=0,
+                        order_by=(), select=None, group_by=()):
         """A hidden method to generate the requested sql query based on the
         parameters requested and returns the resulting cursor.
 
@@ -589,33 +3637,172 @@ class Model(object):
                 'SELECT', 'UPDATE', 'INSERT' or 'DELETE' based on what the 
                 intended action is.
             where: Dict containing the named fields and values to put in the
-                WHERE of the sql statement.
+                WHERE of the sql statement, or a Q object. The names can end
+                with a lookup such as "__gt", see Q for the full list.
             data: Dict containing the named fields and values of the intended
                 values to udpate or insert into database.
+            limit: Maximum number of rows a SELECT returns. None for no limit.
+            offset: Number of rows a SELECT skips before returning rows.
+            order_by: Names of the columns a SELECT is ordered by. Names
+                starting with "-" are in descending order.
+            select: Tuple of sql expressions a SELECT returns instead of
+                the model's columns, for example ("COUNT(*)",).
+            group_by: Names of the columns a SELECT is grouped by.
+
+        Returns:
+            The cursor of the executed statement.
+
+        """
+        statement, parameters = cls._build_query(query, where, data,
+                                                 limit, offset, order_by,
+                                                 select, group_by)
+        return cls._execute(query, statement, parameters)
+
+    @classmethod
+    def _execute(cls, query, statement, parameters):
+        """A hidden method to execute a statement of the model, reporting
+        it to Instrumentation if it's enabled.
+
+        Parameters:
+            query: The type of the query, see _generate_query.
+            statement: The sql statement to execute.
+            parameters: The parameters of the statement.
 
         Returns:
             The cursor of the executed statement.
 
         """
+        #Create our cursor and execute the statement with the parameters.
+        #This guarantees protection against sql injection for all data.
+        #finally returns the cursor.
+        cursor = SQLite().cursor()
+        if Instrumentation.enabled:
+            return Instrumentation.execute(cls, query.upper(), cursor, statement, parameters)
+        return cursor.execute(statement, parameters)
+
+    @classmethod
+    def _build_query(cls, query, where={}, data={}, limit=None, offset=0,
+                     order_by=(), select=None, group_by=()):
+        """A hidden method that returns the sql statement and the list of
+        parameters for the requested query without executing it. Takes the
+        same parameters as _generate_query.
+
+        The statement doesn't depend on the values in the where, only on its
+        shape: the lookups used, how they are grouped and the number of
+        values in "__in" lookups. So it is built once for every combination
+        of query, where shape, data columns, selected expressions, grouping,
+        ordering and paging and kept in
+        the model's _statements cache along with how to convert each value
+        of the where. The parameters are then taken from the where and the
+        data in the same order as the cached statement expects them.
+
+        Returns:
+            A tuple with the statement and the list of parameters.
+
+        """
+        if isinstance(where, Q):
+            where_values = []
+            where_shape = where._flatten(where_values)
+        else:
+            #Names without "__" can't have a lookup, which is the common
+            #case, so they skip the call.
+            where_values = list(where.values())
+            where_shape = ("AND", False, tuple([
+                key if "__" not in key else _lookup_shape(key, value)
+                for key, value in where.items()]))
+        data_keys = tuple(data)
+        paged = limit is not None or bool(offset)
+        key = (query, where_shape, data_keys, tuple(order_by), paged,
+               select, tuple(group_by))
+
+        try:
+            statement, specs = cls._statements[key]
+        except KeyError:
+            statement, specs = cls._compile_query(query, where_shape, data_keys,
+                                                  order_by, paged, select,
+                                                  group_by)
+
+            #The number of shapes used is normally small but nothing stops
+            #a program from using a great many of them. Start over instead
+            #of growing without bounds if that happens.
+            if len(cls._statements) >= 500:
+                cls._statements.clear()
+            cls._statements[key] = (statement, specs)
+
+        #The data always comes before the where in the statements, the
+        #paging always at the end.
+        parameters = [data[x] for x in data_keys]
+        for (lookup, convert), value in zip(specs, where_values):
+            if lookup is None:
+                parameters.append(value if convert is None else convert(value, False, False))
+            elif lookup == "isnull":
+                continue
+            elif isinstance(convert, tuple):
+                parameters.extend([x if c is None else c(x, False, False)
+                                   for c, x in zip(convert, value)])
+            else:
+                values = value if lookup in ("in", "range") else (value,)
+                for value in values:
+                    if convert is not None:
+                        value = convert(value, False, False)
+                    if lookup == "startswith":
+                        value = _escape_glob(value) + "*"
+                    elif lookup == "istartswith":
+                        value = _escape_like(value) + "%"
+                    parameters.append(value)
+        if paged:
+            parameters.extend([-1 if limit is None else limit, offset])
+        return statement, parameters
+
+    @classmethod
+    def _check_column(cls, column):
+        """A hidden method that makes sure the column belongs to the model.
+
+        Returns:
+            The field of the column.
+
+        """
+        field = cls._field_by_column.get(column)
+        if field is None:
+            raise TypeError("Found unknown column %s. Model only supports columns %s." %
+                                (column, ', '.join(cls._columns)))
+        return field
+
+    @classmethod
+    def _compile_query(cls, query, where_shape, data_keys, order_by=(), paged=False,
+                       select=None, group_by=()):
+        """A hidden method that builds the sql statement used by _build_query.
 
-        #Loop over both the where and the data dict and make sure the data
-        #or the where statement contains supported columns or fields.
-        for attr in dict(where.items() + data.items()):
-            if attr not in cls._columns:
-                raise TypeError("Found unknown column %s. Model only supports columns %s." %
-                                    (attr, ', '.join(cls._columns)))
+        Parameters:
+            query: The type of the query, see _generate_query.
+            where_shape: The shape of the where, see Q._flatten.
+            data_keys: Names of the columns to update or insert, in the
+                order their parameters will be given.
+            order_by: Names of the columns a SELECT is ordered by.
+            paged: Boolean specifying whether the statement takes LIMIT
+                and OFFSET parameters at the end.
+            select: Sql expressions a SELECT returns, None for all columns.
+            group_by: Names of the columns a SELECT is grouped by.
+
+        Returns:
+            A tuple with the sql statement as a string and a list with a
+            (lookup, to_db_format) tuple for each value in the where, in the
+            same order as the values. The lookup is None for plain equality
+            and to_db_format is None for fields that don't convert values.
 
-        #Ugly workaround so our where statement doesn't fail even
-        #if the where dict is empty.
-        where["1"] = 1
+        """
 
-        #Generates a nice "field1 = ?, field2 = ?" array that we can
-        #quickly join in however we want in the statement.
-        where_query = ' AND '.join(["%s = ?" % x for x in where])
+        #Go over the data columns and make sure they are all supported
+        #columns or fields. The where is checked as it is compiled.
+        for attr in data_keys:
+            cls._check_column(attr)
 
-        #The query list contains a list of data that will be inserted
-        #as parameters into the execute statement for safe inserting.
-        query_list = [where[x] for x in where]
+        #Generates a nice "WHERE field1 = ? AND field2 > ?" string that we
+        #can add to the end of the statement. An empty where matches all.
+        specs = []
+        where_query = cls._compile_where(where_shape, specs)
+        if where_query:
+            where_query = " WHERE " + where_query
 
         query = query.upper()
 
@@ -623,46 +3810,141 @@ class Model(object):
             #The join takes all the column names and adds a comma between
             #each one. This makes sure our select statement has the data
             #in the same order as our columns.
-            statement = "SELECT %s FROM %s WHERE %s" % (', '.join(cls._columns),
-                                                        cls._tablename,
-                                                        where_query)
+            statement = "SELECT %s FROM %s%s" % (', '.join(select or cls._columns),
+                                                 cls._tablename,
+                                                 where_query)
+
+            if group_by:
+                for column in group_by:
+                    cls._check_column(column)
+                statement += " GROUP BY " + ', '.join(group_by)
+            statement += cls._compile_order_by(order_by)
+
+            #SQLite needs a LIMIT for an OFFSET to be valid, -1 meaning
+            #no limit at all.
+            if paged:
+                statement += " LIMIT ? OFFSET ?"
         elif query == "UPDATE":
-            #Go over the data dict and generate a query string containing
-            #the field names. A dict with the fields "id" and "text" will
-            #generate a string containing "id = ? and text = ?"
-            data_query = ' AND '.join(["%s = ?" % x for x in data])
-
-            #Take all the data and add it to the query list
-            query_list = [data[x] for x in data] + query_list
-
-            statement = "UPDATE %s SET %s WHERE %s" % (cls._tablename,
-                                                       data_query,
-                                                       where_query)
+            #Go over the data columns and generate a query string containing
+            #the field names. The columns "id" and "text" will generate a
+            #string containing "id = ?, text = ?"
+            data_query = ', '.join(["%s = ?" % x for x in data_keys])
+
+            statement = "UPDATE %s SET %s%s" % (cls._tablename,
+                                                data_query,
+                                                where_query)
         elif query == "INSERT":
-            #Go over the data dict and generate a query string containing
-            #the field names with a comma inbetween each name.
-            data_query = ', '.join([x for x in data])
-
-            #Take all the data and add it to the query list
-            query_list = [data[x] for x in data]
-
-            #The join statement takes the length of the query list array
-            #and generates same amount of "?" with comma inbetween.
+            #The join statement takes the number of columns and generates
+            #same amount of "?" with comma inbetween.
             statement = "INSERT INTO %s (%s) VALUES (%s)" % (cls._tablename,
-                                                             data_query,
-                                                             ', '.join("?" * len(query_list)))
+                                                             ', '.join(data_keys),
+                                                             ', '.join("?" * len(data_keys)))
         elif query == "DELETE":
-            statement = "DELETE FROM %s WHERE %s" % (cls._tablename,
-                                                     where_query)
+            statement = "DELETE FROM %s%s" % (cls._tablename, where_query)
         else:
             raise TypeError("Requested query was of unknown type. Only supports " +
                             "SELECT, UPDATE, INSERT and DELETE but got '%s'" % query)
+        return statement, specs
 
-        #Create our cursor and execute the statement with the query list
-        #as parameters. This guarantees protection against sql injection
-        #for all data. finally returns the cursor.
-        cursor = SQLite().cursor()
-        return cursor.execute(statement, query_list)
+    @classmethod
+    def _compile_where(cls, shape, specs):
+        """A hidden method that turns the shape of a where into an sql
+        expression, adding the (lookup, to_db_format) of every value it
+        takes to specs.
+
+        Parameters:
+            shape: A (connector, negated, children) tuple, see Q._flatten.
+            specs: List to add the lookup and converter of each value to.
+
+        Returns:
+            The sql expression as a string, empty if the where is empty.
+
+        """
+        connector, negated, children = shape
+        parts = []
+        for child in children:
+            if isinstance(child, tuple) and len(child) == 3:
+                #A group of its own, which needs parentheses around it as
+                #it can use a different connector.
+                expression = cls._compile_where(child, specs)
+                if expression:
+                    parts.append("(%s)" % expression)
+            else:
+                parts.append(cls._compile_lookup(child, specs))
+
+        expression = (" %s " % connector).join(parts)
+        if negated and expression:
+            expression = "NOT (%s)" % expression
+        return expression
+
+    @classmethod
+    def _compile_lookup(cls, shape, specs):
+        """A hidden method that turns a single lookup, such as "id__gt", into
+        an sql expression, adding the (lookup, to_db_format) of the value it
+        takes to specs.
+
+        Parameters:
+            shape: The shape of the lookup, see _lookup_shape.
+            specs: List to add the lookup and converter of the value to.
+
+        Returns:
+            The sql expression as a string.
+
+        """
+        key, size = shape if isinstance(shape, tuple) else (shape, None)
+        column, lookup = _split_lookup(key)
+
+        #Names of several columns, such as "made,id__gt" with a tuple of
+        #values, compare them as row values. Keyset paging uses these, as
+        #sqlite can find where to start in an index with them.
+        if "," in column:
+            columns = column.split(",")
+            if lookup not in ("gt", "gte", "lt", "lte"):
+                raise TypeError("Columns %s can only be compared with gt, gte, lt or lte." %
+                                ', '.join(columns))
+            converters = []
+            for field in [cls._check_column(x) for x in columns]:
+                convert = field.to_db_format
+                if getattr(convert, "__func__", None) is _no_db_conversion:
+                    convert = None
+                converters.append(convert)
+            specs.append((lookup, tuple(converters)))
+            return _lookups[lookup].replace("?", "(%s)" % ', '.join("?" * len(columns))) % (
+                "(%s)" % ', '.join(columns))
+
+        field = cls._check_column(column)
+
+        convert = field.to_db_format
+        if getattr(convert, "__func__", None) is _no_db_conversion:
+            convert = None
+        specs.append((None if lookup == "exact" else lookup, convert))
+
+        if lookup == "in":
+            return "%s IN (%s)" % (column, ', '.join("?" * size))
+        elif lookup == "isnull":
+            return "%s IS %sNULL" % (column, "" if size else "NOT ")
+        return _lookups[lookup] % column
+
+    @classmethod
+    def _compile_order_by(cls, order_by):
+        """A hidden method that turns a list of column names into an
+        ORDER BY clause. Names starting with "-" are in descending order.
+
+        Returns:
+            The ORDER BY clause, with a leading space, or an empty string.
+
+        """
+        if not order_by:
+            return ""
+
+        parts = []
+        for column in order_by:
+            direction = "ASC"
+            if column.startswith("-"):
+                column, direction = column[1:], "DESC"
+            cls._check_column(column)
+            parts.append("%s %s" % (column, direction))
+        return " ORDER BY " + ', '.join(parts)
 
     @classmethod
     def _result_to_model(cls, result):
@@ -670,6 +3952,13 @@ class Model(object):
         instance of the current model class and fills its attributes with
         the values from the array.
 
+        The instance is created without calling __init__ and the values are
+        put straight into its __dict__, or the slots for compact models. The
+        values of fields that convert them are left for the field to convert
+        when they are first read, see Field. Values from the database are not
+        passed through validate, only through from_db_format, so an INTEGER or
+        TEXT column gives back whatever sqlite stored in it.
+
         Parameters:
             result: An array of tuple containing the values for the model's
                 attributes in the order of the model's _columns private
@@ -682,19 +3971,25 @@ class Model(object):
         if result == None:
             return None
 
-        #Create an instance of the model.
-        out = cls()
-        out._saved = True
-
-        #Go over the _columns, find the attribute for it and
-        #assign the value from the result to the attribute.
-        for i in range(0, len(cls._columns)):
-            for attr, value in out.__class__.__dict__.items():
-                if isinstance(value, Field):
-                    if value.column_name == cls._columns[i]:
-                        setattr(out,
-                                attr,
-                                value.from_db_format(result[i]))
+        #Create an empty instance of the model and fill in every value as it
+        #came from the database. The raw values of fields that convert them
+        #are kept for the fields, to be converted on first access.
+        out = cls.__new__(cls)
+        if cls._compact:
+            for slot, value in zip(cls._slots, result):
+                slot.__set__(out, value)
+            out._lazy = cls._lazy_mask
+            out._saved = True
+            out._dirty = _clean
+            return out
+
+        values = out.__dict__
+        if cls._conversions:
+            values.update(zip(cls._plain_attrs, cls._plain_values(result)))
+            values["_row"] = result
+        else:
+            values.update(zip(cls._attrs, result))
+        values["_saved"] = True
         return out
 
     @classmethod
@@ -723,4 +4018,57 @@ class Model(object):
         #Take all the statements in col_statements and join them as comma
         #seperated and add it to our statement.
         statement += "%s)" % ', '.join(col_statements)
-        return statement 
+        return statement
+
+    @classmethod
+    def get_index_statements(cls):
+        """Helper method that generates a CREATE INDEX IF NOT EXISTS
+        statement for each index of the current model.
+
+        Returns:
+            A list of strings containing the CREATE INDEX statements.
+
+        """
+        return [index.get_create_statement(cls._tablename) for index in cls._indexes]
+
+    @classmethod
+    def explain(cls, *args, **kwargs):
+        """Get the query plan SQLite uses to filter on the named parameters.
+        Handy to check that a filter is using an index instead of scanning
+        the whole table. See QuerySet.explain.
+
+        Parameters:
+            *args: Q objects to filter on.
+            **kwargs: Named fields and values to filter on.
+
+        Returns:
+            A list of strings describing each step of the query plan.
+
+        """
+        return cls.filter(*args, **kwargs).explain() 
+
+def _parallel_init(database):
+    """Set up a worker process of Model.parallel_map. It drops the
+    connections inherited from the parent and only reads from the database,
+    which is already set up.
+
+    """
+    SQLite.reset_after_fork()
+    settings.SQLITE_FILE = database
+    SQLite._checked = True
+    SQLite().execute("PRAGMA query_only = ON")
+
+def _parallel_range(task):
+    """Load the instances in a primary key range and call the function of
+    Model.parallel_map with each of them, in a worker process.
+
+    Returns:
+        A list of the results.
+
+    """
+    model, where, func, start, end, ordered = task
+    key = model._primary_key
+    queryset = QuerySet(model, where).filter(**{key + "__gte": start, key + "__lt": end})
+    if ordered:
+        queryset = queryset.order_by(key)
+    return [func(x) for x in queryset]